@@ -0,0 +1,130 @@
+""" AVL Tree ADT.
+    Defines a self-balancing Binary Search Tree with linked nodes. The heights of the two subtrees of every node
+    differ by at most one, so the depth is O(log n) whatever the order of insertions and deletions.
+"""
+
+from __future__ import annotations
+
+__docformat__ = 'reStructuredText'
+
+from typing import TypeVar
+from bst import BinarySearchTree
+from node import AVLTreeNode
+
+
+# generic types
+K = TypeVar('K')
+I = TypeVar('I')
+
+
+class AVLTree(BinarySearchTree[K, I]):
+    """ AVL tree: a BST rebalanced by rotations, keeping subtree_size up to date for kth_smallest. """
+
+    def get_height(self, current: AVLTreeNode) -> int:
+        """
+            Get the height of the subtree rooted at current, 0 for an empty subtree
+            :complexity: O(1)
+        """
+        if current is not None:
+            return current.height
+        else:
+            return 0
+
+    def update(self, current: AVLTreeNode) -> None:
+        """
+            Recomputes the height and subtree_size of current from its children
+            :complexity: O(1)
+        """
+        current.height = max(self.get_height(current.left), self.get_height(current.right)) + 1
+        current.subtree_size = self.get_subtree_size(current.left) + self.get_subtree_size(current.right) + 1
+
+    def get_balance(self, current: AVLTreeNode) -> int:
+        """
+            Returns the height of the left subtree of current minus the height of its right subtree
+            :complexity: O(1)
+        """
+        return self.get_height(current.left) - self.get_height(current.right)
+
+    def rotate_left(self, current: AVLTreeNode) -> AVLTreeNode:
+        """
+            Rotates current down to the left of its right child and returns the new subtree root
+            :complexity: O(1)
+        """
+        child = current.right
+        current.right = child.left
+        child.left = current
+        self.update(current)
+        self.update(child)
+        return child
+
+    def rotate_right(self, current: AVLTreeNode) -> AVLTreeNode:
+        """
+            Rotates current down to the right of its left child and returns the new subtree root
+            :complexity: O(1)
+        """
+        child = current.left
+        current.left = child.right
+        child.right = current
+        self.update(current)
+        self.update(child)
+        return child
+
+    def rebalance(self, current: AVLTreeNode) -> AVLTreeNode:
+        """
+            Updates current and, if its subtrees' heights differ by 2, restores the AVL property with one or two
+            rotations. Returns the new subtree root.
+            :complexity: O(1)
+        """
+        self.update(current)
+        balance = self.get_balance(current)
+        if balance > 1:
+            if self.get_balance(current.left) < 0:
+                current.left = self.rotate_left(current.left)
+            return self.rotate_right(current)
+        if balance < -1:
+            if self.get_balance(current.right) > 0:
+                current.right = self.rotate_right(current.right)
+            return self.rotate_left(current)
+        return current
+
+    def insert_aux(self, current: AVLTreeNode, key: K, item: I) -> AVLTreeNode:
+        """
+            Attempts to insert an item into the tree, it uses the Key to insert it, then rebalances the path
+            back up to the root
+            :complexity: O(CompK * log n), where n is the number of nodes, as the depth is O(log n)
+            CompK is the complexity of comparing the keys
+        """
+        if current is None:  # base case: at the leaf
+            self.length += 1
+            return AVLTreeNode(key, item=item)
+        elif key < current.key:
+            current.left = self.insert_aux(current.left, key, item)
+        elif key > current.key:
+            current.right = self.insert_aux(current.right, key, item)
+        else:  # key == current.key
+            raise ValueError('Inserting duplicate item')
+        return self.rebalance(current)
+
+    def delete_aux(self, current: AVLTreeNode, key: K) -> AVLTreeNode:
+        """
+            Attempts to delete an item from the tree, it uses the Key to determine the node to delete, then
+            rebalances the path back up to the root
+            :complexity: O(CompK * log n), where n is the number of nodes, as the depth is O(log n)
+        """
+        if current is None:  # key not found
+            raise ValueError('Deleting non-existent item')
+        elif key < current.key:
+            current.left = self.delete_aux(current.left, key)
+        elif key > current.key:
+            current.right = self.delete_aux(current.right, key)
+        else:  # we found our key => do actual deletion
+            if current.left is None or current.right is None:
+                self.length -= 1
+                return current.left if current.left is not None else current.right
+
+            # general case => replace by the successor and delete it from the right subtree
+            succ = self.get_successor(current)
+            current.key = succ.key
+            current.item = succ.item
+            current.right = self.delete_aux(current.right, succ.key)
+        return self.rebalance(current)
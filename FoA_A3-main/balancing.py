@@ -1,70 +1,491 @@
 from __future__ import annotations
-from threedeebeetree import Point
-from ratio import Percentiles
+from typing import Iterator
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
+from math import ceil, isqrt
+import os
+import sys
+import tempfile
+from partitioning import Point, BALANCE_SLACK, SPLIT_RATIO, ARRAY_CUTOFF, pivot_random, is_unbalanced_split, \
+    get_ratio_item, get_ratio_index, separate_octants_array
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-def make_ordering(my_coordinate_list: list[Point]) -> list[Point]:
+# With workers, only partitions larger than this are split in the parent, and the batches of partitions handed to the
+# process pool hold up to this many points (or 1 / workers of them if that is more).
+PARALLEL_CUTOFF = 4096
+# Point files hold little-endian int64 x, y, z triples, as in ThreeDeeBeeTree.save.
+POINT_BYTES = 24
+# Rough size of one point held as a tuple in a list, used to check the memory budget of iter_ordering_file.
+POINT_MEMORY = 200
+# Points read from or written to a point file at a time.
+CHUNK_POINTS = 65536
+# Number of points sampled from a partition that is too large for memory to pick its root.
+SAMPLE_SIZE = 4096
+# Band used to pick a root from a sample, narrower than RATIO_BAND to leave room for sampling error.
+SAMPLE_BAND = 25
+# Roots picked from a sample, twice as large each time, for a partition split on disk before the most balanced
+# split is kept even though it fails is_unbalanced_split.
+SAMPLE_ATTEMPTS = 8
+# With approximate, partitions larger than this pick their root from a sample of get_sample_size points.
+APPROXIMATE_CUTOFF = 32
+
+
+def make_ordering(my_coordinate_list: list[Point], workers: int = 1, approximate: bool = False) -> list[Point]:
 
 
     if len(my_coordinate_list) <= 17:
         return my_coordinate_list
+    return list(iter_ordering(my_coordinate_list, workers, approximate))
+
+
+def iter_ordering(coordinate_list: list[Point], workers: int = 1, approximate: bool = False) -> Iterator[Point]:
+    """
+    Generator form of make_ordering: yields the same points in the same order, each root as soon as it is
+    chosen, so the caller can insert or write it while the rest is still being partitioned. With workers > 1
+    the partitions are ordered in a process pool, see iter_ordering_parallel. With approximate, large
+    partitions pick their root from a sample and the ordering is a different one (see split_partition).
+    complexity: see iter_roots and iter_roots_array
+    """
+    if len(coordinate_list) <= 17:
+        yield from coordinate_list
+    elif workers > 1 and len(coordinate_list) > PARALLEL_CUTOFF:
+        yield from iter_ordering_parallel(coordinate_list, workers, approximate)
     else:
-        return get_root(my_coordinate_list, [])
+        yield from iter_partition(coordinate_list, approximate)
+
+
+def iter_partition(coordinate_list: list[Point], approximate: bool = False) -> Iterator[Point]:
+    """
+    Yields the ordering of get_root, on index arrays when NumPy is available and the partition is large enough.
+    complexity: see iter_roots and iter_roots_array
+    """
+    if np is not None and len(coordinate_list) > ARRAY_CUTOFF:
+        return iter_roots_array(coordinate_list, approximate)
+    return iter_roots(coordinate_list, approximate)
+
+
+def get_sample_size(size: int) -> int:
+    """
+    Returns the number of points to sample from a partition of size points to pick an approximate root: a few
+    dozen plus a multiple of the square root of size, so the relative error of the sampled percentiles shrinks
+    as partitions grow while the sample stays a vanishing fraction of them.
+    complexity: O(1)
+    """
+    return min(size, 32 + 2 * isqrt(size))
+
+
+def split_partition(partition: list[Point], approximate: bool = False) -> tuple[Point, list[list[Point]]]:
+    """
+    Picks the root of partition and splits the other points into the 8 octant lists of split_octants.
+    With approximate, a partition larger than APPROXIMATE_CUTOFF picks its root with get_ratio_item from a
+    random sample of get_sample_size points, within the narrower SAMPLE_BAND. The octant sizes of the split
+    then verify it with is_unbalanced_split, and only a split that fails falls back to the exact root.
+    complexity:
+    Best case: O(n) * O(comp), where n = len(partition), when the sampled root passes: one pass to split.
+    Worst case: O(n) * O(comp) expected, when it fails and get_ratio_item runs on the whole partition.
+    """
+    root = None
+    if approximate and len(partition) > APPROXIMATE_CUTOFF:
+        root = get_ratio_item(pivot_random.sample(partition, get_sample_size(len(partition))), SAMPLE_BAND)
+        list_octants = split_octants(root, partition)
+        if is_unbalanced_split([len(octant) for octant in reversed(list_octants)]):
+            root = None
+    if root is None:
+        root = get_ratio_item(partition)
+        list_octants = split_octants(root, partition)
+    return root, list_octants
+
+
+def split_octants(root: Point, partition: list[Point]) -> list[list[Point]]:
+    """
+    Returns the points of partition other than one copy of root in 8 octant lists, octant code 7 (>= root on
+    every axis) first and code 0 last, filled in a single pass over partition.
+    complexity:
+    Best case = Worst case: O(n) * O(comp), where n = len(partition).
+    """
+    x, y, z = root
+    list_octants = [[] for _ in range(8)]
+    # list_octants[7 - code] receives the points of octant code
+    appenders = [octant.append for octant in reversed(list_octants)]
+    for point in partition:
+        appenders[((point[0] >= x) << 2) | ((point[1] >= y) << 1) | (point[2] >= z)](point)
+    # the root is on the >= side of itself on every axis, so only the first octant holds it
+    list_octants[0].remove(root)
+    return list_octants
+
+
+def iter_ordering_parallel(coordinate_list: list[Point], workers: int, approximate: bool = False) -> Iterator[Point]:
+    """
+    Yields the ordering of get_root using a pool of worker processes. The top levels are split here (see
+    get_parallel_plan) and every partition left is ordered in the pool by order_partitions, consecutive small
+    partitions going in one batch, while the roots chosen here are yielded in between. With NumPy a batch is sent
+    as one slice of the (N, 3) coordinate array, which is pickled as its raw buffer, and comes back the same way.
+    The result is the same ordering as without workers, so it keeps the same ratio guarantee.
+    complexity:
+    Best case = Worst case: O(n log n / workers) for the parallel part, plus O(n) per level split here, where
+                n = len(coordinate_list).
+    """
+    coordinates = None if np is None else np.asarray(coordinate_list).reshape(-1, 3)
+    plan, batches = get_parallel_plan(coordinate_list, workers, approximate, coordinates)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = []
+        for batch in batches:
+            rows = list(chain.from_iterable(batch)) if np is None else coordinates[np.concatenate(batch)]
+            futures.append(pool.submit(order_partitions, rows, [len(partition) for partition in batch], approximate))
+        del batches
+        # batches hold consecutive partitions of the plan, so their results are consumed in plan order
+        results = iter(futures)
+        ordered, cursor = [], 0
+        for decided, entry in plan:
+            if decided:
+                yield entry
+                continue
+            if cursor == len(ordered):
+                ordered, cursor = next(results).result(), 0
+                if np is not None:
+                    ordered = get_row_points(ordered)
+            yield from ordered[cursor:cursor + len(entry)]
+            cursor += len(entry)
+
+
+def get_parallel_plan(coordinate_list: list[Point], workers: int, approximate: bool = False,
+                      coordinates=None) -> tuple[list[tuple[bool, object]], list[list]]:
+    """
+    Splits the top levels of coordinate_list for iter_ordering_parallel, level by level and only partitions larger
+    than PARALLEL_CUTOFF, until there are at least workers partitions left or none of them is larger. Returns the
+    plan, the chosen roots as (True, root) and the partitions left as (False, partition) in their final order,
+    and those partitions in batches of consecutive ones, each batch holding up to about 1 / workers of the points
+    unless a single partition is larger. With NumPy (coordinates being coordinate_list as an (N, 3) array),
+    partitions are arrays of row indices split by split_partition_array, otherwise lists split by
+    split_partition.
+    complexity:
+    Best case = Worst case: O(n) per level, vectorised with NumPy, where n = len(coordinate_list).
+    """
+    plan = [(False, coordinate_list if coordinates is None else np.arange(len(coordinate_list)))]
+    while True:
+        pending = [entry for decided, entry in plan if not decided]
+        if len(pending) >= workers or all(len(entry) <= PARALLEL_CUTOFF for entry in pending):
+            break
+        expanded = []
+        for decided, entry in plan:
+            if decided or len(entry) <= PARALLEL_CUTOFF:
+                expanded.append((decided, entry))
+            elif coordinates is None:
+                root, list_octants = split_partition(entry, approximate)
+                expanded.append((True, root))
+                expanded.extend((False, octant) for octant in list_octants if octant)
+            else:
+                position, octants = split_partition_array(coordinates, entry, approximate)
+                expanded.append((True, coordinate_list[int(entry[position])]))
+                expanded.extend((False, octant) for octant in octants if len(octant))
+        plan = expanded
+
+    target = max(PARALLEL_CUTOFF, ceil(sum(map(len, pending)) / workers))
+    batches, batch, batch_size = [], [], 0
+    for partition in pending:
+        if batch and batch_size + len(partition) > target:
+            batches.append(batch)
+            batch, batch_size = [], 0
+        batch.append(partition)
+        batch_size += len(partition)
+    if batch:
+        batches.append(batch)
+    return plan, batches
+
+
+def order_partitions(rows, sizes: list[int], approximate: bool = False):
+    """
+    Worker of iter_ordering_parallel: rows holds the points of consecutive partitions, sizes[i] points for the
+    i-th, as an (N, 3) array with NumPy or a list of points without it. Returns the ordering of get_root of each
+    partition in turn, in the same form as rows.
+    complexity: see iter_partition
+    """
+    points = rows if np is None else get_row_points(rows)
+    ordered, start = [], 0
+    for size in sizes:
+        ordered.extend(iter_partition(points[start:start + size], approximate))
+        start += size
+    return ordered if np is None else np.array(ordered, dtype=rows.dtype).reshape(-1, 3)
+
+
+def get_row_points(rows) -> list[Point]:
+    """
+    Returns the rows of an (N, 3) array as point tuples, zipped from the three columns, which is several times
+    faster than converting each row.
+    complexity: O(N)
+    """
+    return list(zip(rows[:, 0].tolist(), rows[:, 1].tolist(), rows[:, 2].tolist()))
+
+
+def iter_roots(coordinate_list: list[Point], approximate: bool = False) -> Iterator[Point]:
+    """
+    Yields the ordering of get_root. Partitions wait on an explicit stack rather than in recursive calls, so the
+    depth of the split is not limited by the recursion limit. Each partition is dropped once it is split, so the
+    stack holds each remaining point once. With approximate (see split_partition), a partition of at most
+    BALANCE_SLACK + 1 points is yielded as it is, like make_ordering does for small inputs: no split below it
+    can have more than BALANCE_SLACK points on one side.
+    complexity:
+    Best case = Worst case: O(n log n) * O(comp) expected for a balanced split, where n = len(coordinate_list):
+                O(log n) levels of get_ratio_item and split_octants.
+    """
+    stack = [coordinate_list]
+    while stack:
+        partition = stack.pop()
+        if len(partition) <= 1 or approximate and len(partition) <= BALANCE_SLACK + 1:
+            yield from partition
+            continue
+        root, list_octants = split_partition(partition, approximate)
+        yield root
+        del partition
+        stack.extend(octant for octant in reversed(list_octants) if octant)
+
+
+def iter_roots_array(coordinate_list: list[Point], approximate: bool = False) -> Iterator[Point]:
+    """
+    NumPy form of iter_roots. The points are put in one (N, 3) array, keeping their dtype so float coordinates
+    are not truncated, and every partition is an array of row indices into it: its root is picked by
+    get_ratio_index and it is split by separate_octants_array. Partitions of at most ARRAY_CUTOFF points go on
+    through iter_roots as lists, where the per call overhead of NumPy would dominate. approximate works as in
+    split_partition, the split being checked with the octant sizes.
+    complexity:
+    Best case = Worst case: O(n log n), where n = len(coordinate_list), the depth being O(log n) and every level
+                doing O(n) vectorised work (plus the sorts of get_ratio_index).
+    """
+    coordinates = np.asarray(coordinate_list).reshape(-1, 3)
+    stack = [np.arange(len(coordinate_list))]
+    while stack:
+        indices = stack.pop()
+        if len(indices) <= ARRAY_CUTOFF:
+            yield from iter_roots([coordinate_list[index] for index in indices.tolist()], approximate)
+            continue
+        position, octants = split_partition_array(coordinates, indices, approximate)
+        yield coordinate_list[indices[position]]
+        # same visiting order as iter_roots
+        stack.extend(octant for octant in reversed(octants) if len(octant))
+
+
+def split_partition_array(coordinates, indices, approximate: bool = False) -> tuple[int, list]:
+    """
+    NumPy form of split_partition for a partition given as an array of row indices into coordinates: returns the
+    position in indices of its root, picked by get_ratio_index, and the 8 octant index arrays of
+    separate_octants_array. approximate works as in split_partition.
+    complexity:
+    Best case = Worst case: O(m log m), where m = len(indices), see get_ratio_index.
+    """
+    if approximate and len(indices) > APPROXIMATE_CUTOFF:
+        sample = np.array(pivot_random.sample(range(len(indices)), get_sample_size(len(indices))))
+        position = int(sample[get_ratio_index(coordinates[indices[sample]], SAMPLE_BAND)])
+        octants = separate_octants_array(coordinates, np.delete(indices, position), coordinates[indices[position]])
+        if not is_unbalanced_split([len(octant) for octant in reversed(octants)]):
+            return position, octants
+    position = get_ratio_index(coordinates[indices])
+    return position, separate_octants_array(coordinates, np.delete(indices, position), coordinates[indices[position]])
 
 
 def get_root(coordinate_list, lst):
-    if len(coordinate_list) <= 1:
-        lst.append(coordinate_list[0])
-        return lst
-
-    root = get_ratio_item(coordinate_list)
-    if root is not None:
-        lst.append(root)
-        coordinate_list.remove(root)    #O(n) complexity for removing
-        return find_octant_child(root, coordinate_list, lst)
-
-
-def find_octant_child(root, coordinate_list, lst):
-    list_octants = separate_octants(root,coordinate_list, 0,[])
-    for list_item in list_octants:
-        if len(list_item) != 0:
-            lst = get_root(list_item, lst)
+    lst.extend(iter_roots(coordinate_list))
     return lst
 
 
-def separate_octants(root: Point, coordinate_list, indicator, list_oct):
-    elems_0, elems_1 = [], []
-    for item in coordinate_list:
-        if item[indicator] >= root[indicator]:
-            elems_0.append(item)
-        else:
-            elems_1.append(item)
-    if indicator == 2:
-        list_oct.append(elems_0)
-        list_oct.append(elems_1)
-        return list_oct
+def write_points_file(path: str, points) -> None:
+    """
+    Writes points to path as a point file (little-endian int64 x, y, z triples).
+    complexity: O(n), where n is the number of points.
+    """
+    with open(path, 'wb') as file:
+        chunk = array('q')
+        for point in points:
+            chunk.extend(point)
+            if len(chunk) >= 3 * CHUNK_POINTS:
+                write_chunk(file, chunk)
+                chunk = array('q')
+        write_chunk(file, chunk)
+
+
+def write_chunk(file, chunk: array) -> None:
+    """ Writes a flat coordinate array to an open point file. """
+    if sys.byteorder == 'big':
+        chunk = array('q', chunk)
+        chunk.byteswap()
+    file.write(chunk.tobytes())
+
+
+def read_chunks(path: str) -> Iterator[array]:
+    """
+    Yields the contents of a point file as flat coordinate arrays of at most CHUNK_POINTS points each.
+    complexity: O(n), where n is the number of points in the file.
+    """
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(POINT_BYTES * CHUNK_POINTS)
+            if not data:
+                return
+            chunk = array('q')
+            chunk.frombytes(data)
+            if sys.byteorder == 'big':
+                chunk.byteswap()
+            yield chunk
+
+
+def read_points_file(path: str) -> Iterator[Point]:
+    """
+    Yields the points of a point file, reading it in chunks.
+    complexity: O(n), where n is the number of points in the file.
+    """
+    for chunk in read_chunks(path):
+        for index in range(0, len(chunk), 3):
+            yield chunk[index], chunk[index + 1], chunk[index + 2]
+
+
+def sample_points_file(path: str, count: int, size: int) -> list[Point]:
+    """
+    Returns size points read from random positions of a point file holding count points (all of them, in file
+    order, if count <= size).
+    complexity: O(size) seeks and reads.
+    """
+    if count <= size:
+        return list(read_points_file(path))
+    sample = []
+    with open(path, 'rb') as file:
+        for position in sorted(pivot_random.sample(range(count), size)):
+            file.seek(POINT_BYTES * position)
+            point = array('q')
+            point.frombytes(file.read(POINT_BYTES))
+            if sys.byteorder == 'big':
+                point.byteswap()
+            sample.append(tuple(point))
+    return sample
+
+
+def iter_ordering_file(path: str, memory_budget: int = 1 << 30, spill_dir: str | None = None) -> Iterator[Point]:
+    """
+    Out-of-core form of iter_ordering for a point file that may not fit in memory. A partition whose points would
+    take more than memory_budget bytes as tuples (POINT_MEMORY each) is not loaded: its root is picked by
+    get_ratio_item, within the narrower SAMPLE_BAND, from SAMPLE_SIZE points sampled from disk, and the partition
+    is streamed in chunks into 8 per-octant spill files in a temporary directory (inside spill_dir if given).
+    The octant counts of the split are checked with is_unbalanced_split, and an unlucky sample is replaced by a
+    new one twice as large (at most the points that fit in memory_budget), up to SAMPLE_ATTEMPTS times. Resampling
+    stops early, keeping the most balanced split, when a larger sample did not improve the split or when an
+    unbalanced axis has fewer than 3 distinct values in the sample, as with planar data, where no root can pass. Partitions that fit are loaded and ordered in memory by iter_partition. Pending partitions wait on a
+    stack in the same order as iter_roots, so at most about 7 spill files per level are on disk at once, and each
+    one is deleted once it is split or loaded. The ordering differs from make_ordering in the levels split on
+    disk.
+    complexity:
+    Best case: O(n log n), where n is the number of points, plus O(n) reads and writes of the file for every
+               level of the split done on disk.
+    Worst case: SAMPLE_ATTEMPTS times the reads and writes of the best case, when every sample is unlucky and
+                each larger one improves the split, which is vanishingly unlikely.
+    """
+    count = os.path.getsize(path) // POINT_BYTES
+    if count * POINT_MEMORY <= memory_budget:
+        yield from iter_ordering(list(read_points_file(path)))
+        return
+
+    with tempfile.TemporaryDirectory(dir=spill_dir) as directory:
+        spills = 0
+        # entries are (path of a point file, number of points, whether it is a spill file to delete after use)
+        stack = [(path, count, False)]
+        while stack:
+            partition_path, count, spilled = stack.pop()
+            if count * POINT_MEMORY <= memory_budget:
+                points = list(read_points_file(partition_path))
+                if spilled:
+                    os.remove(partition_path)
+                yield from iter_partition(points)
+                continue
+
+            # best is (worst split ratio, root, octant counts, octant paths) of the most balanced split so far
+            best = None
+            sample_size = SAMPLE_SIZE
+            for _ in range(SAMPLE_ATTEMPTS):
+                sample = sample_points_file(partition_path, count, sample_size)
+                root = get_ratio_item(sample, SAMPLE_BAND)
+                octant_paths = [os.path.join(directory, 'spill{0}.bin'.format(spills + code)) for code in range(8)]
+                spills += 8
+                counts = split_points_file(partition_path, root, octant_paths)
+                split = (get_split_ratio(counts), root, counts, octant_paths)
+                improved = best is None or split[0] < best[0]
+                if improved:
+                    best, split = split, best
+                if split is not None:
+                    for octant_path in split[3]:
+                        os.remove(octant_path)
+                if not is_unbalanced_split(counts):
+                    break
+                # a larger sample cannot help an axis with too few distinct values for get_ratio_item to pick a
+                # value in band, and is not worth another pass over the file if it did not improve the split
+                if not improved or any(get_split_ratio(counts, axis) > SPLIT_RATIO
+                                       and len({point[axis] for point in sample}) < 3 for axis in range(3)):
+                    break
+                sample_size = min(2 * sample_size, memory_budget // POINT_MEMORY)
+            _, root, counts, octant_paths = best
 
-    list_oct = separate_octants(root, elems_0, indicator + 1, list_oct)
-    list_oct = separate_octants(root, elems_1, indicator + 1, list_oct)
-    return list_oct
+            yield root
+            if spilled:
+                os.remove(partition_path)
+            # octant code 7 first, as in split_octants
+            for code in range(8):
+                if counts[code]:
+                    stack.append((octant_paths[code], counts[code], True))
+                else:
+                    os.remove(octant_paths[code])
 
 
-def get_ratio_item(coordinate_list):
-    if len(coordinate_list) <= 1:
-        return coordinate_list[0]
+def get_split_ratio(octant_sizes: list[int], axis: int | None = None) -> float:
+    """
+    Returns the worst larger:smaller size ratio between the two sides of a split on any axis (only on axis if
+    given), given octant_sizes[code] as in is_unbalanced_split, inf if a side is empty.
+    complexity: O(1)
+    """
+    total = sum(octant_sizes)
+    worst = 1
+    for axis in range(3) if axis is None else (axis,):
+        positive = sum(size for code, size in enumerate(octant_sizes) if code >> (2 - axis) & 1)
+        smaller, larger = min(positive, total - positive), max(positive, total - positive)
+        worst = max(worst, larger / smaller if smaller else float('inf'))
+    return worst
 
-    a = 12.5
-    lst = []
-    x_p, y_p, z_p = Percentiles(), Percentiles(), Percentiles()
-    for item in coordinate_list:
-        x_p.add_point(item[0])
-        y_p.add_point(item[1])
-        z_p.add_point(item[2])
 
-    x_list, y_list, z_list = x_p.ratio(a, a), y_p.ratio(a, a), z_p.ratio(a, a)
+def split_points_file(path: str, root: Point, octant_paths: list[str]) -> list[int]:
+    """
+    Streams the point file at path into the 8 files of octant_paths, octant_paths[code] receiving the points
+    whose octant code relative to root is code. One copy of root is left out. Returns the number of points
+    written to each file.
+    complexity: O(n), where n is the number of points in the file.
+    """
+    x, y, z = root
+    files = [open(octant_path, 'wb') for octant_path in octant_paths]
+    try:
+        buffers = [array('q') for _ in range(8)]
+        counts = [0] * 8
+        root_left_out = False
+        for point in read_points_file(path):
+            if not root_left_out and point == root:
+                root_left_out = True
+                continue
+            code = ((point[0] >= x) << 2) | ((point[1] >= y) << 1) | (point[2] >= z)
+            buffers[code].extend(point)
+            counts[code] += 1
+            if len(buffers[code]) >= 3 * CHUNK_POINTS:
+                write_chunk(files[code], buffers[code])
+                buffers[code] = array('q')
+        for code in range(8):
+            write_chunk(files[code], buffers[code])
+    finally:
+        for file in files:
+            file.close()
+    return counts
 
-    for item in coordinate_list:
-        if item[0] in x_list and item[1] in y_list and item[2] in z_list:
-            return item
-    return coordinate_list[0]
 
+def write_ordering_file(path: str, out_path: str, memory_budget: int = 1 << 30, spill_dir: str | None = None) -> None:
+    """
+    Writes the ordering of iter_ordering_file for the point file at path to the point file out_path, as it is
+    produced.
+    complexity: see iter_ordering_file
+    """
+    write_points_file(out_path, iter_ordering_file(path, memory_budget, spill_dir))
@@ -0,0 +1,341 @@
+""" Linear octree: a read-mostly alternative to ThreeDeeBeeTree.
+
+Points are stored as Morton (Z-order) codes, i.e. the bits of the x, y and z coordinates interleaved, in one
+sorted contiguous array. Exact lookups are binary searches and box queries scan the Morton interval between
+the codes of the box corners, skipping the runs of codes that leave the box.
+"""
+from __future__ import annotations
+from typing import Generic, Iterator, TypeVar
+from array import array
+from bisect import bisect_left, bisect_right
+from threedeebeetree import Point, ThreeDeeBeeTree
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+I = TypeVar('I')
+
+# Bits per axis, coordinates must lie in [-COORD_OFFSET, COORD_OFFSET).
+COORD_BITS = 21
+COORD_OFFSET = 1 << (COORD_BITS - 1)
+CODE_BITS = 3 * COORD_BITS
+# Every third bit set, starting from bit 0.
+AXIS_BITS = 0x1249249249249249
+# Code bits of the x, y and z coordinate. Masking a code with one of them keeps the order of that coordinate.
+AXIS_MASKS = (AXIS_BITS << 2, AXIS_BITS << 1, AXIS_BITS)
+# Codes outside the box that iter_range steps over one at a time before jumping ahead with get_bigmin.
+SCAN_RUN = 8
+# With NumPy, iter_range filters Morton intervals holding more than this many codes in vectorised form.
+VECTOR_CUTOFF = 64
+
+
+def spread_bits(value: int) -> int:
+    """
+    Spreads the COORD_BITS low bits of value so that there are two zero bits between each of them.
+    complexity: O(1)
+    """
+    value &= 0x1fffff
+    value = (value | value << 32) & 0x1f00000000ffff
+    value = (value | value << 16) & 0x1f0000ff0000ff
+    value = (value | value << 8) & 0x100f00f00f00f00f
+    value = (value | value << 4) & 0x10c30c30c30c30c3
+    value = (value | value << 2) & 0x1249249249249249
+    return value
+
+
+def compact_bits(value: int) -> int:
+    """
+    Inverse of spread_bits: gathers every third bit of value, starting from bit 0.
+    complexity: O(1)
+    """
+    value &= 0x1249249249249249
+    value = (value ^ (value >> 2)) & 0x10c30c30c30c30c3
+    value = (value ^ (value >> 4)) & 0x100f00f00f00f00f
+    value = (value ^ (value >> 8)) & 0x1f0000ff0000ff
+    value = (value ^ (value >> 16)) & 0x1f00000000ffff
+    value = (value ^ (value >> 32)) & 0x1fffff
+    return value
+
+
+# spread_bits of every 11-bit value, so encode spreads a coordinate with two lookups.
+SPREAD_TABLE = [spread_bits(value) for value in range(1 << 11)]
+
+
+def check_point(point: Point) -> None:
+    """ Raises ValueError if point cannot be encoded as a Morton code. """
+    for coordinate in point:
+        if not -COORD_OFFSET <= coordinate < COORD_OFFSET:
+            raise ValueError('Coordinate {0} of {1} is outside [{2}, {3})'.format(
+                coordinate, point, -COORD_OFFSET, COORD_OFFSET))
+
+
+def encode(point: Point) -> int:
+    """
+    Returns the Morton code of point. The x bit is the most significant of each group of three, so the top
+    three bits of a code are the octant code of the point relative to the origin, as in ThreeDeeBeeTree.
+    complexity: O(1)
+    """
+    x, y, z = point[0] + COORD_OFFSET, point[1] + COORD_OFFSET, point[2] + COORD_OFFSET
+    table = SPREAD_TABLE
+    # the high 10 bits of a coordinate spread to 33 bits above its low 11 bits
+    return (table[x >> 11] << 35 | table[x & 0x7ff] << 2) | (table[y >> 11] << 34 | table[y & 0x7ff] << 1) | \
+        (table[z >> 11] << 33 | table[z & 0x7ff])
+
+
+def decode(code: int) -> Point:
+    """
+    Returns the point whose Morton code is code.
+    complexity: O(1)
+    """
+    return (compact_bits(code >> 2) - COORD_OFFSET, compact_bits(code >> 1) - COORD_OFFSET,
+            compact_bits(code) - COORD_OFFSET)
+
+
+def encode_many(points) -> np.ndarray:
+    """
+    Vectorised encode of an (N, 3) integer array, returning an int64 array of codes.
+    complexity: O(N)
+    """
+    points = np.asarray(points, dtype=np.int64).reshape(-1, 3)
+    if points.size and (points.min() < -COORD_OFFSET or points.max() >= COORD_OFFSET):
+        raise ValueError('Coordinates must lie in [{0}, {1})'.format(-COORD_OFFSET, COORD_OFFSET))
+    codes = np.zeros(len(points), dtype=np.uint64)
+    for axis in range(3):
+        value = (points[:, axis] + COORD_OFFSET).astype(np.uint64)
+        for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f),
+                            (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)):
+            value = (value | (value << np.uint64(shift))) & np.uint64(mask)
+        codes |= value << np.uint64(2 - axis)
+    return codes.astype(np.int64)
+
+
+def decode_many(codes) -> np.ndarray:
+    """
+    Vectorised decode of an int64 array of codes, returning an (N, 3) int64 array of points.
+    complexity: O(N)
+    """
+    codes = np.asarray(codes, dtype=np.int64).astype(np.uint64)
+    points = np.empty((len(codes), 3), dtype=np.int64)
+    for axis in range(3):
+        value = (codes >> np.uint64(2 - axis)) & np.uint64(0x1249249249249249)
+        for shift, mask in ((2, 0x10c30c30c30c30c3), (4, 0x100f00f00f00f00f), (8, 0x1f0000ff0000ff),
+                            (16, 0x1f00000000ffff), (32, 0x1fffff)):
+            value = (value ^ (value >> np.uint64(shift))) & np.uint64(mask)
+        points[:, axis] = value.astype(np.int64) - COORD_OFFSET
+    return points
+
+
+def get_bigmin(code: int, zmin: int, zmax: int) -> int:
+    """
+    Returns the smallest Morton code greater than code that lies inside the box whose corners have the codes
+    zmin and zmax (the BIGMIN computation of Tropf and Herzog). code must lie in [zmin, zmax] but outside the box.
+    complexity:
+    Best case = Worst case: O(B), where B = CODE_BITS, one step per bit.
+    """
+    bigmin = zmax
+    # code shares every bit above the highest bit where zmin and zmax differ, so those steps do nothing
+    for position in range((zmin ^ zmax).bit_length() - 1, -1, -1):
+        bit = 1 << position
+        lower = (bit - 1) & (AXIS_BITS << (position % 3))
+        state = (bool(code & bit), bool(zmin & bit), bool(zmax & bit))
+        if state == (False, False, True):
+            bigmin = (zmin | bit) & ~lower
+            zmax = (zmax & ~bit) | lower
+        elif state == (False, True, True):
+            return zmin
+        elif state == (True, False, False):
+            return bigmin
+        elif state == (True, False, True):
+            zmin = (zmin | bit) & ~lower
+    return bigmin
+
+
+class LinearOctree(Generic[I]):
+    """ Read-mostly point map stored as a sorted array of Morton codes. """
+
+    def __init__(self) -> None:
+        """
+            Initialises an empty linear octree, use from_points to build one
+        """
+        self.codes = array('q')
+        self.items = []
+
+    @classmethod
+    def from_points(cls, points: list[Point], items: list[I] | None = None) -> LinearOctree[I]:
+        """
+            Builds a linear octree holding points, items[i] being the item of points[i] (None if items is not
+            given). With NumPy the codes are computed and sorted in vectorised form. Repeated points keep their
+            last item.
+            complexity:
+            Best case = Worst case: O(n log n), where n is the number of points, for the sort.
+        """
+        if items is None:
+            items = [None] * len(points)
+        elif len(items) != len(points):
+            raise ValueError('points and items must have the same length')
+
+        tree = cls()
+        if len(points) == 0:
+            return tree
+        if np is not None:
+            codes = encode_many(points)
+            order = np.argsort(codes, kind='stable')
+            codes = codes[order]
+            # keep the last of each run of equal codes
+            last = np.append(codes[1:] != codes[:-1], True)
+            tree.codes.frombytes(codes[last].tobytes())
+            tree.items = [items[i] for i in order[last].tolist()]
+        else:
+            item_of = {}
+            for point, item in zip(points, items):
+                check_point(point)
+                item_of[encode(point)] = item
+            for code in sorted(item_of):
+                tree.codes.append(code)
+                tree.items.append(item_of[code])
+        return tree
+
+    def __len__(self) -> int:
+        """ Returns the number of points in the tree. """
+        return len(self.codes)
+
+    def is_empty(self) -> bool:
+        return len(self) == 0
+
+    def get_position(self, key: Point) -> int:
+        """
+            Returns the position of key in the sorted code array, raises KeyError if it is not there.
+            complexity:
+            Best case = Worst case: O(log n), binary search over n codes.
+        """
+        try:
+            check_point(key)
+        except ValueError:
+            raise KeyError('Key not found: {0}'.format(key))
+        code = encode(key)
+        position = bisect_left(self.codes, code)
+        if position == len(self.codes) or self.codes[position] != code:
+            raise KeyError('Key not found: {0}'.format(key))
+        return position
+
+    def __contains__(self, key: Point) -> bool:
+        try:
+            self.get_position(key)
+            return True
+        except KeyError:
+            return False
+
+    def __getitem__(self, key: Point) -> I:
+        return self.items[self.get_position(key)]
+
+    def __iter__(self) -> Iterator[Point]:
+        """ Yields the keys in Morton order. """
+        for code in self.codes:
+            yield decode(code)
+
+    def range_query(self, lo: Point, hi: Point) -> list[tuple[Point, I]]:
+        """
+            Returns every (key, item) pair whose key lies inside the box lo <= key <= hi.
+            complexity: see iter_range
+        """
+        return list(self.iter_range(lo, hi))
+
+    def iter_range(self, lo: Point, hi: Point) -> Iterator[tuple[Point, I]]:
+        """
+            Lazily yields every (key, item) pair whose key lies inside the box lo <= key <= hi, in Morton order.
+            Every such code lies between the codes zmin and zmax of lo and hi, and a code is inside the box when
+            each of its AXIS_MASKS parts lies between those of zmin and zmax, so no code is decoded to be tested.
+            With NumPy, an interval of more than VECTOR_CUTOFF codes is filtered in one vectorised pass. Otherwise
+            the interval is scanned, stepping over up to SCAN_RUN codes outside the box before jumping to the next
+            code that can be inside it (get_bigmin).
+            The Morton interval of a box can hold many more codes than the box, e.g. when the box straddles a
+            boundary where a high code bit changes, and the vectorised pass reads all of them. A ThreeDeeBeeTree
+            prunes by octant instead and is usually faster for boxes without NumPy, while the linear octree builds
+            faster and keeps its points in one compact array.
+            complexity:
+            Best case: O(log n), when no point lies in the Morton interval of the box.
+            Worst case: O(W), where W is the number of codes in the Morton interval, done in vectorised form with
+                        NumPy. Without NumPy, O(k * (SCAN_RUN + B + log n)), where k is the number of points
+                        reported plus the number of times the scan leaves the box, and B is the number of code bits.
+        """
+        lo = tuple(max(min(c, COORD_OFFSET - 1), -COORD_OFFSET) for c in lo)
+        hi = tuple(max(min(c, COORD_OFFSET - 1), -COORD_OFFSET) for c in hi)
+        if any(lo[axis] > hi[axis] for axis in range(3)):
+            return
+        codes, items = self.codes, self.items
+        zmin, zmax = encode(lo), encode(hi)
+        x_mask, y_mask, z_mask = AXIS_MASKS
+        lo_x, lo_y, lo_z = zmin & x_mask, zmin & y_mask, zmin & z_mask
+        hi_x, hi_y, hi_z = zmax & x_mask, zmax & y_mask, zmax & z_mask
+        position, end = bisect_left(codes, zmin), bisect_right(codes, zmax)
+
+        if np is not None and end - position > VECTOR_CUTOFF:
+            window = np.frombuffer(codes, dtype=np.int64)[position:end]
+            x, y, z = window & x_mask, window & y_mask, window & z_mask
+            inside = (x >= lo_x) & (x <= hi_x) & (y >= lo_y) & (y <= hi_y) & (z >= lo_z) & (z <= hi_z)
+            positions = np.flatnonzero(inside)
+            keys = decode_many(window[positions]).tolist()
+            # release the view of the code array
+            del window, x, y, z
+            for key, found in zip(keys, (positions + position).tolist()):
+                yield tuple(key), items[found]
+            return
+
+        misses = 0
+        while position < end:
+            code = codes[position]
+            if lo_x <= code & x_mask <= hi_x and lo_y <= code & y_mask <= hi_y and lo_z <= code & z_mask <= hi_z:
+                yield decode(code), items[position]
+                position += 1
+                misses = 0
+            elif misses < SCAN_RUN:
+                position += 1
+                misses += 1
+            else:
+                position = bisect_left(codes, get_bigmin(code, zmin, zmax), position + 1, end)
+                misses = 0
+
+
+# The point map implementations that can back an index over hive positions.
+BACKENDS = {
+    'tree': ThreeDeeBeeTree,
+    'linear': LinearOctree,
+}
+
+
+def make_index(points: list[Point], items: list | None = None, backend: str = 'tree'):
+    """
+    Builds a point map over points with the selected backend: 'tree' for a balanced ThreeDeeBeeTree, which also
+    supports updates, or 'linear' for a read-only LinearOctree.
+    """
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend {0!r}, expected one of {1}'.format(backend, sorted(BACKENDS)))
+    return BACKENDS[backend].from_points(points, items)
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    random.seed(20231)
+    coords = list(range(300000))
+    random.shuffle(coords)
+    points = [tuple(coords[3 * i:3 * i + 3]) for i in range(20000)]
+    boxes = []
+    for _ in range(200):
+        lo = tuple(random.randint(0, 280000) for _ in range(3))
+        boxes.append((lo, tuple(c + 40000 for c in lo)))
+
+    for backend in BACKENDS:
+        start = time.perf_counter()
+        index = make_index(points, list(range(len(points))), backend)
+        built = time.perf_counter()
+        for point in points:
+            index[point]
+        looked_up = time.perf_counter()
+        found = sum(len(index.range_query(lo, hi)) for lo, hi in boxes)
+        queried = time.perf_counter()
+        print('{0:>6}: build {1:.3f}s, {2} lookups {3:.3f}s, {4} box queries {5:.3f}s ({6} points)'.format(
+            backend, built - start, len(points), looked_up - built, len(boxes), queried - looked_up, found))
@@ -33,3 +33,10 @@ class TreeNode(Generic[K, I]):
         key = str(self.key) if type(self.key) != str else "'{0}'".format(self.key)
         item = str(self.item) if type(self.item) != str else "'{0}'".format(self.item)
         return '({0}, {1}, [{2}])'.format(key, item, self.subtree_size)
+
+
+@dataclass
+class AVLTreeNode(TreeNode[K, I]):
+    """ BST node that also stores the height of its subtree, for AVL trees. """
+
+    height: int = 1
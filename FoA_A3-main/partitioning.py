@@ -0,0 +1,152 @@
+""" Root selection and octant splitting shared by balancing and ThreeDeeBeeTree.
+
+A partition's root is its first point lying inside the RATIO_BAND percentiles of the distinct values of every
+axis, and the split it makes is checked with is_unbalanced_split. balancing orders points with these, and
+ThreeDeeBeeTree builds and rebuilds its subtrees with them, so both give the same trees.
+"""
+from __future__ import annotations
+from typing import Tuple
+from math import ceil
+from random import Random
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+Point = Tuple[int, int, int]
+
+# Percentage of the distinct values of each axis left out on both sides when picking a root.
+RATIO_BAND = 12.5
+# Axes with up to this many distinct values are sorted to find the band bounds instead of using select_kth: the
+# C sort is faster than the Python quickselect until roughly a million values.
+SELECT_CUTOFF = 1 << 20
+pivot_random = Random(0)
+# With NumPy, partitions are picked and split on index arrays until they are no larger than this, then on lists.
+ARRAY_CUTOFF = 64
+# Both sides of a split may hold up to this many nodes whatever their ratio (see is_unbalanced_split).
+BALANCE_SLACK = 17
+# Largest size ratio between the two sides of a split on any axis allowed by the balance criterion of make_ordering.
+SPLIT_RATIO = 7
+# Partitions up to this size have a lower band rank of 1 on every axis, so the band bounds are the smallest and
+# largest value.
+MIN_MAX_CUTOFF = 8
+
+
+def is_unbalanced_split(octant_sizes: list[int], ratio: float = SPLIT_RATIO) -> bool:
+    """
+    Checks a split given octant_sizes[code], the number of nodes in the octant with each 3-bit code: it is
+    unbalanced if on some axis the larger side holds more than BALANCE_SLACK nodes and more than ratio times the
+    nodes of the smaller side. Shared by ThreeDeeBeeTree.is_unbalanced and the approximate roots of balancing.
+    complexity: O(1)
+    """
+    total = sum(octant_sizes)
+    for axis in range(3):
+        positive = sum(size for code, size in enumerate(octant_sizes) if code >> (2 - axis) & 1)
+        smaller, larger = min(positive, total - positive), max(positive, total - positive)
+        if larger > BALANCE_SLACK and larger > ratio * smaller:
+            return True
+    return False
+
+
+def select_kth(values: list, k: int):
+    """
+    Returns the k-th smallest (0-based) of values, which must be distinct, by quickselect with random pivots.
+    complexity:
+    Best case: O(n) * O(comp), where n = len(values).
+    Worst case: O(n^2) * O(comp), when every pivot is the smallest or largest value left, which is vanishingly
+                unlikely with random pivots. The expected cost is O(n) * O(comp).
+    """
+    while len(values) > SELECT_CUTOFF:
+        pivot = values[pivot_random.randrange(len(values))]
+        lower = [value for value in values if value < pivot]
+        if k < len(lower):
+            values = lower
+        elif k == len(lower):
+            return pivot
+        else:
+            k -= len(lower) + 1
+            values = [value for value in values if value > pivot]
+    return sorted(values)[k]
+
+
+def get_ratio_item(coordinate_list, band: float = RATIO_BAND):
+    """
+    Returns the first point of coordinate_list whose coordinate on every axis lies strictly between the
+    band and (100 - band) percentiles of the distinct values of that axis, the same bounds as
+    Percentiles.ratio(band, band). If no point qualifies the first point is returned. The two bounds
+    of each axis are found by quickselect over the distinct values instead of building a Percentiles BST,
+    or by one sort below SELECT_CUTOFF values, and are the smallest and largest value for small partitions.
+    complexity:
+    Best case = Worst case: O(n) * O(comp) expected, where n = len(coordinate_list): a set of values, two
+                selections and one scan of the points for each axis. Below SELECT_CUTOFF distinct values the
+                sort makes it O(n log n) * O(comp), done in C.
+    """
+    if len(coordinate_list) <= 2:
+        # at most 2 distinct values per axis leave no value strictly inside the band
+        return coordinate_list[0]
+
+    # with at most MIN_MAX_CUTOFF distinct values the lower rank is 1 and the upper rank the number of values
+    min_max = len(coordinate_list) <= MIN_MAX_CUTOFF and band * MIN_MAX_CUTOFF <= 100
+    bounds = []
+    for values in zip(*coordinate_list):
+        if min_max:
+            bounds.append((min(values), max(values)))
+            continue
+        values = list(set(values))
+        lower_rank = ceil(len(values) * band / 100)
+        upper_rank = len(values) - lower_rank + 1
+        if lower_rank >= upper_rank - 1:
+            # the band between the bounds holds no value
+            return coordinate_list[0]
+        if len(values) <= SELECT_CUTOFF:
+            # one sort gives both bounds, select_kth would sort twice
+            values.sort()
+            bounds.append((values[lower_rank - 1], values[upper_rank - 1]))
+        else:
+            bounds.append((select_kth(values, lower_rank - 1), select_kth(values, upper_rank - 1)))
+
+    (lo_x, hi_x), (lo_y, hi_y), (lo_z, hi_z) = bounds
+    for item in coordinate_list:
+        if lo_x < item[0] < hi_x and lo_y < item[1] < hi_y and lo_z < item[2] < hi_z:
+            return item
+    return coordinate_list[0]
+
+
+def get_ratio_index(coordinates, band: float = RATIO_BAND):
+    """
+    NumPy form of get_ratio_item over the rows of an (N, 3) array: returns the position of the first row inside
+    the band on every axis, or 0 if there is none.
+    complexity:
+    Best case = Worst case: O(n log n), where n = len(coordinates), for the sorts; the rest is O(n).
+    """
+    inside = np.ones(len(coordinates), dtype=bool)
+    for axis in range(3):
+        # distinct values by one sort and a mask: np.unique may hash first, which is many times slower on ints
+        values = np.sort(coordinates[:, axis])
+        values = values[np.concatenate(([True], values[1:] != values[:-1]))]
+        lower_rank = ceil(len(values) * band / 100)
+        upper_rank = len(values) - lower_rank + 1
+        if lower_rank >= upper_rank - 1:
+            return 0
+        column = coordinates[:, axis]
+        inside &= (column > values[lower_rank - 1]) & (column < values[upper_rank - 1])
+    return int(np.argmax(inside)) if inside.any() else 0
+
+
+def separate_octants_array(coordinates, indices, root):
+    """
+    NumPy form of balancing.split_octants: splits the row indices into 8 arrays by the octant of their row
+    relative to root, in the same order as split_octants (octant code 7, i.e. >= root on every axis, first). The
+    3-bit codes are computed in one vectorised comparison and the indices are grouped by a single stable argsort,
+    so each returned array is a view into it and keeps the input order.
+    complexity:
+    Best case = Worst case: O(n log n), where n = len(indices), for the sort.
+    """
+    greater = coordinates[indices] >= root
+    codes = (greater[:, 0].astype(np.int8) << 2) | (greater[:, 1].astype(np.int8) << 1) | greater[:, 2]
+    # sort by 7 - code so the octant order matches split_octants
+    codes = 7 - codes
+    ordered = indices[np.argsort(codes, kind='stable')]
+    ends = np.cumsum(np.bincount(codes, minlength=8)).tolist()
+    return [ordered[start:end] for start, end in zip([0] + ends[:-1], ends)]
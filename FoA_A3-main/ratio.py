@@ -2,6 +2,7 @@ from __future__ import annotations
 from typing import Generic, TypeVar
 from math import ceil, floor
 from bst import BinarySearchTree
+from avl import AVLTree
 from node import TreeNode
 
 T = TypeVar("T")
@@ -10,12 +11,15 @@ I = TypeVar("I")
 
 class Percentiles(Generic[T]):
 
-    def __init__(self) -> None:
+    def __init__(self, balanced: bool = True) -> None:
         """
+        balanced: keep the points in an AVLTree, so that add_point, remove_point and the kth_smallest lookups of
+        ratio are O(log n) * O(comp) whatever the order of the points. False uses a plain BinarySearchTree, which
+        degrades to O(n) per operation on sorted input.
         Complexity:
         Best = worst case: O(1), creating a BST.
         """
-        self.bst = BinarySearchTree()
+        self.bst = AVLTree() if balanced else BinarySearchTree()
 
     
     def add_point(self, item: T) -> None:
@@ -32,6 +36,8 @@ class Percentiles(Generic[T]):
         Worst case: O(n)*O(comp), when the BST is highly unbalanced,
         all elements in the BST skew to the left, and the element to be added is
         smaller than all elements in the BST, which needs to traverse the BST, taking O(n) complexity.
+
+        With balanced (the default) the BST is an AVLTree: Best case = Worst case: O(logn)*O(comp).
         """
         self.bst[item] = item
     
@@ -46,6 +52,8 @@ class Percentiles(Generic[T]):
 
         Worst case: O(n)*O(comp), when the BST is highly unbalanced,
         all elements in the BST skew to one side (left/right), and traversing the BST takes O(n) complexity.
+
+        With balanced (the default) the BST is an AVLTree: Best case = Worst case: O(logn)*O(comp).
         """
 
         del self.bst[item]
@@ -1,10 +1,17 @@
+import os
 import random
+import tempfile
 import unittest
+import balancing
 from ed_utils.decorators import number, visibility
 from ed_utils.timeout import timeout
 
-from threedeebeetree import ThreeDeeBeeTree, BeeNode
-from balancing import make_ordering
+from threedeebeetree import ThreeDeeBeeTree, BeeNode, is_unbalanced_split
+from partitioning import RATIO_BAND
+from ratio import Percentiles
+from balancing import make_ordering, get_ratio_item, get_root, iter_roots_array, \
+    separate_octants_array, iter_ordering, iter_ordering_file, write_ordering_file, write_points_file, \
+    read_points_file, iter_roots, get_parallel_plan, np
 
 def get_size(node):
     if node is None:
@@ -88,6 +95,31 @@ def collect_worst_ratio(node: BeeNode):
     ]))
 
 
+# Original form of get_ratio_item, building a Percentiles BST of the distinct values of each axis
+def get_percentile_ratio_item(coordinate_list):
+    if len(coordinate_list) <= 1:
+        return coordinate_list[0]
+
+    a = RATIO_BAND
+    x_p, y_p, z_p = Percentiles(), Percentiles(), Percentiles()
+    # Percentiles cannot hold repeated values, so each distinct coordinate is only added once
+    for axis, percentiles in enumerate((x_p, y_p, z_p)):
+        for value in dict.fromkeys(item[axis] for item in coordinate_list):
+            percentiles.add_point(value)
+
+    x_list, y_list, z_list = x_p.ratio(a, a), y_p.ratio(a, a), z_p.ratio(a, a)
+
+    for item in coordinate_list:
+        if item[0] in x_list and item[1] in y_list and item[2] in z_list:
+            return item
+    return coordinate_list[0]
+
+
+# NumPy form of get_root, giving the same ordering
+def make_ordering_array(coordinate_list):
+    return list(iter_roots_array(coordinate_list))
+
+
 class TestBalancing(unittest.TestCase):
     
     @timeout()
@@ -123,3 +155,247 @@ class TestBalancing(unittest.TestCase):
         ratio, smaller, axis = collect_worst_ratio(tdbt.root)
         self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
 
+
+    @timeout()
+    @number("4.3")
+    def test_from_points(self):
+        random.seed(10239123)
+        points = []
+        coords = list(range(10000))
+        random.shuffle(coords)
+        for i in range(3000):
+            point = (coords[3*i], coords[3*i+1], coords[3*i+2])
+            points.append(point)
+
+        tdbt = ThreeDeeBeeTree.from_points(points, list(range(len(points))))
+        self.assertEqual(len(tdbt), len(points))
+        self.assertEqual(tdbt.root.subtree_size, len(points))
+        for i, p in enumerate(points):
+            self.assertEqual(tdbt[p], i)
+
+        ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+        self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+
+    @timeout()
+    @number("4.4")
+    def test_from_points_parallel(self):
+        random.seed(10239123)
+        points = []
+        coords = list(range(10000))
+        random.shuffle(coords)
+        for i in range(3000):
+            point = (coords[3*i], coords[3*i+1], coords[3*i+2])
+            points.append(point)
+
+        for workers in (2, 20):
+            tdbt = ThreeDeeBeeTree.from_points(points, list(range(len(points))), workers=workers)
+            self.assertEqual(len(tdbt), len(points))
+            self.assertEqual(tdbt.root.subtree_size, len(points))
+            self.assertEqual(len(tdbt.store), len(points))
+            for i, p in enumerate(points):
+                self.assertEqual(tdbt[p], i)
+
+            ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+            self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+
+    @timeout()
+    @number("4.5")
+    def test_stats(self):
+        tdbt = ThreeDeeBeeTree()
+        self.assertEqual(tdbt.stats()['size'], 0)
+        for i in range(40):
+            tdbt[(i, i, i)] = i
+        stats = tdbt.stats()
+        self.assertEqual(stats['size'], 40)
+        self.assertListEqual(stats['depth_histogram'], [1] * 40)
+        self.assertEqual(stats['max_path_length'], 40)
+        self.assertEqual(stats['average_path_length'], 20.5)
+        self.assertListEqual(stats['fan_out'], [1, 39] + [0] * 7)
+        self.assertDictEqual(stats['worst_ratio'], {'x': float('inf'), 'y': float('inf'), 'z': float('inf')})
+
+        random.seed(1405)
+        points = list({(random.randint(0, 1000), random.randint(0, 1000), random.randint(0, 1000)) for _ in range(2000)})
+        tdbt = ThreeDeeBeeTree.from_points(points)
+        stats = tdbt.stats()
+        self.assertEqual(stats['size'], len(points))
+        self.assertEqual(sum(stats['depth_histogram']), len(points))
+        self.assertEqual(sum(stats['fan_out']), len(points))
+        self.assertEqual(sum(k * count for k, count in enumerate(stats['fan_out'])), len(points) - 1)
+        self.assertLessEqual(max(stats['worst_ratio'].values()), 7)
+        self.assertLess(stats['average_path_length'], stats['max_path_length'])
+
+    @timeout()
+    @number("4.6")
+    def test_ratio_item(self):
+        random.seed(4646)
+        for size in (2, 3, 8, 9, 17, 40, 300, 1000):
+            for spread in (3, 50, 10000):
+                points = [(random.randint(0, spread), random.randint(0, spread), random.randint(0, spread))
+                          for _ in range(size)]
+                self.assertEqual(get_ratio_item(points), get_percentile_ratio_item(points))
+
+        sorted_points = [(i, i, i) for i in range(1000)]
+        self.assertEqual(get_ratio_item(sorted_points), (125, 125, 125))
+
+    @timeout()
+    @number("4.7")
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    def test_array_ordering(self):
+        random.seed(4747)
+        for spread in (6, 200, 100000):
+            points = [(random.randint(0, spread), random.randint(0, spread), random.randint(0, spread))
+                      for _ in range(3000)]
+            self.assertListEqual(make_ordering_array(points), get_root(points[:], []))
+
+            # from_points partitions large subtrees on arrays too and must build the same tree
+            points = list(dict.fromkeys(points))
+            inserted = ThreeDeeBeeTree()
+            for p in get_root(points[:], []):
+                inserted[p] = None
+            self.assertListEqual(list(ThreeDeeBeeTree.from_points(points).keys()), list(inserted.keys()))
+
+        # float coordinates are ordered as they are, not truncated to integers
+        points = [(random.uniform(-5, 5), random.uniform(-5, 5), random.uniform(-5, 5)) for _ in range(3000)]
+        self.assertListEqual(make_ordering_array(points), get_root(points[:], []))
+        self.assertListEqual(make_ordering(points[:]), get_root(points[:], []))
+
+        coordinates = np.array([(0, 0, 0), (5, 5, 5), (-1, 7, 2), (9, -3, -3), (5, 4, 6)])
+        octants = separate_octants_array(coordinates, np.arange(5), coordinates[1])
+        self.assertListEqual([octant.tolist() for octant in octants], [[1], [], [4], [3], [], [2], [], [0]])
+
+    @timeout()
+    @number("4.8")
+    def test_iter_ordering(self):
+        random.seed(4848)
+        coords = list(range(10000))
+        random.shuffle(coords)
+        points = [(coords[3*i], coords[3*i+1], coords[3*i+2]) for i in range(3000)]
+        ordering = iter_ordering(points)
+        self.assertEqual(next(ordering), make_ordering(points[:])[0])
+        tdbt = ThreeDeeBeeTree()
+        tdbt[make_ordering(points[:])[0]] = None
+        for point in ordering:
+            tdbt[point] = None
+        self.assertEqual(len(tdbt), len(points))
+        ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+        self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+
+        # every point on one line: the split is as deep as the input, far past the recursion limit
+        line = [(0, 0, i) for i in range(1500)]
+        self.assertListEqual(get_root(line[:], []), line)
+
+    @timeout()
+    @number("4.9")
+    def test_parallel_ordering(self):
+        random.seed(4949)
+        coords = list(range(60000))
+        random.shuffle(coords)
+        points = [(coords[3*i], coords[3*i+1], coords[3*i+2]) for i in range(20000)]
+
+        # count the points handed to the pool, which must be all of them but the roots chosen in the parent
+        submitted = []
+        class CountingPool(balancing.ProcessPoolExecutor):
+            def submit(self, fn, rows, sizes, *args):
+                submitted.append(sum(sizes))
+                return super().submit(fn, rows, sizes, *args)
+        pool = balancing.ProcessPoolExecutor
+        balancing.ProcessPoolExecutor = CountingPool
+        try:
+            for workers in (32, 3):
+                del submitted[:]
+                ordering = make_ordering(points[:], workers=workers)
+                self.assertListEqual(ordering, make_ordering(points[:]))
+                plan, _ = get_parallel_plan(points, workers, coordinates=None if np is None else np.asarray(points))
+                roots = sum(1 for decided, _ in plan if decided)
+                self.assertGreater(len(submitted), 1)
+                self.assertEqual(sum(submitted), len(points) - roots)
+        finally:
+            balancing.ProcessPoolExecutor = pool
+        tdbt = ThreeDeeBeeTree()
+        for i, p in enumerate(ordering):
+            tdbt[p] = i
+        ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+        self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+
+    @timeout()
+    @number("4.10")
+    def test_ordering_file(self):
+        random.seed(41010)
+        coords = list(range(60000))
+        random.shuffle(coords)
+        points = [(coords[3*i], coords[3*i+1] - 30000, coords[3*i+2]) for i in range(20000)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'points.bin')
+            write_points_file(path, points)
+            self.assertListEqual(list(read_points_file(path)), points)
+            # fits in memory: same as make_ordering
+            self.assertListEqual(list(iter_ordering_file(path)), make_ordering(points[:]))
+
+            spill_dir = os.path.join(directory, 'spill')
+            os.mkdir(spill_dir)
+            out_path = os.path.join(directory, 'ordering.bin')
+            write_ordering_file(path, out_path, memory_budget=200 * 1500, spill_dir=spill_dir)
+            self.assertListEqual(os.listdir(spill_dir), [])
+            ordering = list(read_points_file(out_path))
+
+            # samples of 8 points often give a root out of band, so the splits on disk depend on the resampling
+            sample_size = balancing.SAMPLE_SIZE
+            balancing.SAMPLE_SIZE = 8
+            balancing.pivot_random.seed(0)
+            try:
+                resampled = list(iter_ordering_file(path, memory_budget=200 * 1500))
+            finally:
+                balancing.SAMPLE_SIZE = sample_size
+
+            # no root can pass on planar points, so each partition on disk is split once, not resampled
+            planar = [(x, y, 0) for x, y, _ in points[:6000]]
+            write_points_file(path, planar)
+            split_paths = []
+            split_points_file = balancing.split_points_file
+            def split_once(partition_path, root, octant_paths):
+                split_paths.append(partition_path)
+                return split_points_file(partition_path, root, octant_paths)
+            balancing.split_points_file = split_once
+            try:
+                self.assertCountEqual(iter_ordering_file(path, memory_budget=200 * 1500), planar)
+            finally:
+                balancing.split_points_file = split_points_file
+            self.assertGreater(len(split_paths), 0)
+            self.assertEqual(len(split_paths), len(set(split_paths)))
+
+        self.assertCountEqual(ordering, points)
+        tdbt = ThreeDeeBeeTree()
+        for i, p in enumerate(ordering):
+            tdbt[p] = i
+        ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+        self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+
+        self.assertCountEqual(resampled, points)
+        tdbt = ThreeDeeBeeTree()
+        for i, p in enumerate(resampled):
+            tdbt[p] = i
+        ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+        self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+
+    @timeout()
+    @number("4.11")
+    def test_approximate_ordering(self):
+        random.seed(41111)
+        coords = list(range(60000))
+        random.shuffle(coords)
+        points = [(coords[3*i], coords[3*i+1], coords[3*i+2]) for i in range(20000)]
+
+        for ordering in (make_ordering(points[:], approximate=True), list(iter_roots(points[:], True))):
+            self.assertCountEqual(ordering, points)
+            tdbt = ThreeDeeBeeTree()
+            for i, p in enumerate(ordering):
+                tdbt[p] = i
+            ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+            self.assertLessEqual(ratio, 7, f"Axis {axis} has ratio 1:{ratio}.")
+            self.assertLessEqual(max(tdbt.stats()['worst_ratio'].values()), 7)
+
+        self.assertFalse(is_unbalanced_split([10, 10, 10, 10, 10, 10, 10, 10]))
+        self.assertFalse(is_unbalanced_split([17, 0, 0, 0, 0, 0, 0, 0]))
+        self.assertTrue(is_unbalanced_split([70, 1, 1, 1, 1, 1, 1, 1]))
+        self.assertTrue(is_unbalanced_split([0, 30, 0, 30, 0, 30, 0, 30]))
@@ -1,8 +1,10 @@
+import random
 import unittest
 from ed_utils.decorators import number, visibility
 from ed_utils.timeout import timeout
 
 from bst import BinarySearchTree
+from avl import AVLTree
 
 class BSTTest(unittest.TestCase):
 
@@ -79,3 +81,31 @@ class BSTTest(unittest.TestCase):
         self.assertEqual(kth.item, 1)
 
 
+
+    @timeout()
+    @number("1.3")
+    def test_avl(self):
+        AVL = AVLTree()
+        for key in range(2000):
+            AVL[key] = key * 2
+        self.assertEqual(len(AVL), 2000)
+        self.assertEqual(AVL.root.subtree_size, 2000)
+        self.assertLessEqual(AVL.root.height, 16)
+        self.assertEqual(AVL.kth_smallest(1, AVL.root).key, 0)
+        self.assertEqual(AVL.kth_smallest(1234, AVL.root).item, 2466)
+
+        random.seed(1313)
+        keys = list(range(2000))
+        random.shuffle(keys)
+        for key in keys[:1500]:
+            del AVL[key]
+        remaining = sorted(keys[1500:])
+        self.assertEqual(len(AVL), 500)
+        self.assertEqual(AVL.root.subtree_size, 500)
+        self.assertLessEqual(AVL.root.height, 12)
+        for k in range(1, 501):
+            self.assertEqual(AVL.kth_smallest(k, AVL.root).key, remaining[k - 1])
+        self.assertNotIn(keys[0], AVL)
+        self.assertEqual(AVL[remaining[0]], remaining[0] * 2)
+        self.assertRaises(ValueError, AVL.__setitem__, remaining[0], 0)
+        self.assertRaises(ValueError, AVL.__delitem__, keys[0])
@@ -0,0 +1,56 @@
+import random
+import unittest
+from ed_utils.decorators import number, visibility
+from ed_utils.timeout import timeout
+
+from linear_octree import LinearOctree, decode, encode, make_index, COORD_OFFSET
+
+class TestLinearOctree(unittest.TestCase):
+
+    TESTING_POINTS = [
+        (6, -1, -17),
+        (-11, 4, -16),
+        (5, 5, 7),
+        (-16, 2, -6),
+        (10, -20, 1),
+        (-14, 18, -4),
+        (-18, 7, 5),
+        (16, 0, -14),
+        (-6, -14, 12),
+        (4, 6, 19)
+    ]
+
+    @timeout()
+    @number("3.11")
+    def test_lookup(self):
+        for point in self.TESTING_POINTS + [(-COORD_OFFSET, COORD_OFFSET - 1, 0)]:
+            self.assertEqual(decode(encode(point)), point)
+
+        tree = LinearOctree.from_points(self.TESTING_POINTS, list(range(10)))
+        self.assertEqual(len(tree), 10)
+        for i, point in enumerate(self.TESTING_POINTS):
+            self.assertIn(point, tree)
+            self.assertEqual(tree[point], i)
+        self.assertNotIn((0, 0, 0), tree)
+        self.assertNotIn((1 << 40, 0, 0), tree)
+        self.assertRaises(KeyError, tree.__getitem__, (1, 2, 3))
+
+        tree = LinearOctree.from_points([(1, 1, 1), (2, 2, 2), (1, 1, 1)], ["a", "b", "c"])
+        self.assertEqual(len(tree), 2)
+        self.assertEqual(tree[(1, 1, 1)], "c")
+
+    @timeout()
+    @number("3.12")
+    def test_range_query(self):
+        random.seed(90210)
+        points = [tuple(random.randint(-300, 300) for _ in range(3)) for _ in range(2000)]
+        linear = make_index(points, points, backend='linear')
+        tree = make_index(points, points, backend='tree')
+        for _ in range(30):
+            lo = tuple(random.randint(-300, 300) for _ in range(3))
+            # small boxes have short Morton intervals, which are scanned rather than filtered with NumPy
+            hi = tuple(c + random.randint(0, random.choice((5, 200))) for c in lo)
+            expected = {p for p in points if all(lo[a] <= p[a] <= hi[a] for a in range(3))}
+            self.assertSetEqual({key for key, _ in linear.iter_range(lo, hi)}, expected)
+            self.assertSetEqual(set(linear.range_query(lo, hi)), set(tree.range_query(lo, hi)))
+        self.assertRaises(ValueError, make_index, points, backend='unknown')
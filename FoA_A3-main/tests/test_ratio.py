@@ -39,4 +39,21 @@ class RatioTest(unittest.TestCase):
 
         p.remove_point(82)
         res = p.ratio(13, 10)
-        self.assertSetEqual(set(res), {14, 15, 16, 87, 91})
\ No newline at end of file
+        self.assertSetEqual(set(res), {14, 15, 16, 87, 91})
+
+    @timeout()
+    @number("2.3")
+    def test_sorted_stream(self):
+        balanced, plain = Percentiles(), Percentiles(balanced=False)
+        for point in range(800):
+            balanced.add_point(point)
+            plain.add_point(point)
+        self.assertListEqual(sorted(balanced.ratio(49.5, 49.5)), sorted(plain.ratio(49.5, 49.5)))
+        self.assertLessEqual(balanced.bst.root.height, 11)
+
+        # far past the recursion limit for a plain BST
+        for point in range(800, 20000):
+            balanced.add_point(point)
+        for point in range(0, 20000, 2):
+            balanced.remove_point(point)
+        self.assertListEqual(sorted(balanced.ratio(10, 10)), list(range(2001, 18001, 2)))
@@ -1,8 +1,12 @@
+import os
+import random
+import tempfile
+import threading
 import unittest
 from ed_utils.decorators import number, visibility
 from ed_utils.timeout import timeout
 
-from threedeebeetree import ThreeDeeBeeTree
+from threedeebeetree import ThreeDeeBeeTree, REBUILD_RATIO, np
 
 class TestThreeDeeBeeTree(unittest.TestCase):
 
@@ -64,3 +68,530 @@ class TestThreeDeeBeeTree(unittest.TestCase):
         
         self.assertEqual(tdbt.get_tree_node_by_key((16, 0, -14)).item, 7)
         self.assertEqual(tdbt.get_tree_node_by_key((6, -1, -17)).item, 0)
+
+    @timeout()
+    @number("3.4")
+    def test_missing_and_duplicate_keys(self):
+        tdbt = ThreeDeeBeeTree()
+        self.assertNotIn((0, 0, 0), tdbt)
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        self.assertNotIn((1, 1, 1), tdbt)
+        self.assertRaises(KeyError, tdbt.get_tree_node_by_key, (1, 1, 1))
+
+        tdbt[(5, 5, 7)] = "replaced"
+        self.assertEqual(len(tdbt), 10)
+        self.assertEqual(tdbt.root.subtree_size, 10)
+        self.assertEqual(tdbt[(5, 5, 7)], "replaced")
+
+    @timeout()
+    @number("3.5")
+    def test_store_layout(self):
+        tdbt = ThreeDeeBeeTree()
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        store = tdbt.store
+        self.assertEqual(len(store), 10)
+        self.assertEqual(len(store.children), 8 * len(store))
+        for index in range(len(store)):
+            self.assertEqual(store.get_key(index), self.TESTING_POINTS[index])
+            self.assertEqual(store.items[index], index)
+        # (-11, 4, -16) is on the negative x and positive y, z side of the root: octant code 0b011
+        self.assertEqual(tdbt.root.get_octant((-11, 4, -16)), 0b011)
+        self.assertEqual(store.get_child(tdbt.root_index, 0b011), 1)
+
+    @timeout()
+    @number("3.6")
+    def test_range_query(self):
+        tdbt = ThreeDeeBeeTree()
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        res = tdbt.range_query((-20, 0, -20), (5, 20, 0))
+        self.assertSetEqual(set(res), {((-11, 4, -16), 1), ((-16, 2, -6), 3), ((-14, 18, -4), 5)})
+        self.assertEqual(tdbt.range_query((100, 100, 100), (200, 200, 200)), [])
+
+        random.seed(4891)
+        tdbt = ThreeDeeBeeTree()
+        points = [tuple(random.randint(-50, 50) for _ in range(3)) for _ in range(500)]
+        for point in points:
+            tdbt[point] = point
+        for _ in range(20):
+            lo = tuple(random.randint(-50, 50) for _ in range(3))
+            hi = tuple(c + random.randint(0, 40) for c in lo)
+            expected = {p for p in points if all(lo[a] <= p[a] <= hi[a] for a in range(3))}
+            self.assertSetEqual({key for key, _ in tdbt.iter_range(lo, hi)}, expected)
+
+    @timeout()
+    @number("3.7")
+    def test_nearest(self):
+        tdbt = ThreeDeeBeeTree()
+        self.assertEqual(tdbt.nearest((0, 0, 0), 3), [])
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        self.assertEqual(tdbt.nearest((5, 5, 6)), [((5, 5, 7), 2)])
+        self.assertEqual(len(tdbt.nearest((0, 0, 0), 50)), 10)
+
+        random.seed(77102)
+        tdbt = ThreeDeeBeeTree()
+        points = list({tuple(random.randint(-100, 100) for _ in range(3)) for _ in range(800)})
+        for point in points:
+            tdbt[point] = point
+        for _ in range(20):
+            query = tuple(random.randint(-120, 120) for _ in range(3))
+            distance = lambda p: sum((p[a] - query[a]) ** 2 for a in range(3))
+            expected = sorted(distance(p) for p in points)[:5]
+            found = tdbt.nearest(query, 5)
+            self.assertEqual([distance(key) for key, _ in found], expected)
+
+    @timeout()
+    @number("3.8")
+    def test_delete(self):
+        tdbt = ThreeDeeBeeTree()
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        del tdbt[(-18, 7, 5)]   # leaf
+        del tdbt[(-11, 4, -16)] # inner node with 5 nodes below it
+        del tdbt[(6, -1, -17)]  # root
+        self.assertRaises(KeyError, tdbt.__delitem__, (6, -1, -17))
+
+        remaining = [p for p in self.TESTING_POINTS if p not in [(-18, 7, 5), (-11, 4, -16), (6, -1, -17)]]
+        self.assertEqual(len(tdbt), len(remaining))
+        self.assertEqual(tdbt.root.subtree_size, len(remaining))
+        for point in remaining:
+            self.assertEqual(tdbt[point], self.TESTING_POINTS.index(point))
+        self.assertNotIn((-11, 4, -16), tdbt)
+
+        for point in remaining:
+            del tdbt[point]
+        self.assertTrue(tdbt.is_empty())
+        self.assertIsNone(tdbt.root)
+
+    @timeout()
+    @number("3.9")
+    def test_automatic_rebuild(self):
+        from tests.test_balancing import collect_worst_ratio
+
+        random.seed(5512)
+        tdbt = ThreeDeeBeeTree(balance_ratio=REBUILD_RATIO)
+        # sorted insertions would make a single long path without rebuilding
+        points = [(i, i, i) for i in range(800)]
+        for point in points:
+            tdbt[point] = point
+        removed = set(random.sample(points, 300))
+        for point in removed:
+            del tdbt[point]
+
+        self.assertEqual(len(tdbt), 500)
+        self.assertEqual(tdbt.root.subtree_size, 500)
+        for point in points:
+            self.assertEqual(point in tdbt, point not in removed)
+        ratio, smaller, axis = collect_worst_ratio(tdbt.root)
+        self.assertLessEqual(ratio, REBUILD_RATIO, f"Axis {axis} has ratio 1:{ratio}.")
+
+        # built subtrees may be split close to 1:7, so smaller ratios would rebuild on every update
+        for ratio in (0.5, 2, REBUILD_RATIO - 1):
+            self.assertRaises(ValueError, ThreeDeeBeeTree, balance_ratio=ratio)
+
+    @unittest.skipIf(np is None, "NumPy is not installed")
+    @timeout()
+    @number("3.10")
+    def test_batch_lookup(self):
+        tdbt = ThreeDeeBeeTree()
+        self.assertFalse(tdbt.contains_many(np.zeros((3, 3), dtype=int)).any())
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        queries = np.array(self.TESTING_POINTS[::-1] + [(0, 0, 0), (5, 5, 8)])
+        found = tdbt.contains_many(queries)
+        self.assertListEqual(found.tolist(), [True] * 10 + [False, False])
+        items = tdbt.get_many(queries, default=-1)
+        self.assertListEqual(items.tolist(), list(range(9, -1, -1)) + [-1, -1])
+
+        # integral floats match like in __contains__, other values are not truncated into a match
+        self.assertListEqual(tdbt.contains_many(np.array([(5.0, 5.0, 7.0)])).tolist(), [True])
+        self.assertRaises(ValueError, tdbt.contains_many, np.array([(5.9, 5, 7)]))
+        self.assertRaises(ValueError, tdbt.get_many, [(5.9, 5, 7)])
+
+    @timeout()
+    @number("3.13")
+    def test_save_and_open(self):
+        tdbt = ThreeDeeBeeTree()
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = {"hive": i}
+        del tdbt[(-16, 2, -6)]
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "hives.3dbt")
+            tdbt.save(path)
+            for mmap in (True, False):
+                loaded = ThreeDeeBeeTree.open(path, mmap=mmap)
+                self.assertEqual(len(loaded), 9)
+                self.assertEqual(loaded.root.subtree_size, 9)
+                self.assertEqual(loaded.root.key, tdbt.root.key)
+                for i, point in enumerate(self.TESTING_POINTS):
+                    if point == (-16, 2, -6):
+                        self.assertNotIn(point, loaded)
+                    else:
+                        self.assertEqual(loaded[point], {"hive": i})
+                self.assertSetEqual({key for key, _ in loaded.range_query((-20, 0, -20), (5, 20, 0))},
+                                    {key for key, _ in tdbt.range_query((-20, 0, -20), (5, 20, 0))})
+                self.assertEqual(loaded.read_only, mmap)
+                del loaded
+
+            mapped = ThreeDeeBeeTree.open(path)
+            self.assertRaises(TypeError, mapped.__setitem__, (0, 0, 0), 1)
+            del mapped
+
+            ThreeDeeBeeTree().save(path)
+            self.assertEqual(len(ThreeDeeBeeTree.open(path)), 0)
+
+    @timeout()
+    @number("3.14")
+    def test_box_aggregates(self):
+        random.seed(60411)
+        tdbt = ThreeDeeBeeTree(balance_ratio=REBUILD_RATIO)
+        self.assertEqual(tdbt.count_in_box((0, 0, 0), (1, 1, 1)), 0)
+        tdbt.add_aggregate('sum')
+        tdbt.add_aggregate('max')
+        tdbt.add_aggregate('min_weight', min, value=lambda item: -item)
+        points = {}
+        for _ in range(600):
+            point = tuple(random.randint(-40, 40) for _ in range(3))
+            points[point] = random.randint(0, 1000)
+            tdbt[point] = points[point]
+        for point in random.sample(sorted(points), 150):
+            del tdbt[point]
+            del points[point]
+
+        for _ in range(30):
+            lo = tuple(random.randint(-40, 40) for _ in range(3))
+            hi = tuple(c + random.randint(0, 50) for c in lo)
+            inside = [item for p, item in points.items() if all(lo[a] <= p[a] <= hi[a] for a in range(3))]
+            self.assertEqual(tdbt.count_in_box(lo, hi), len(inside))
+            self.assertEqual(tdbt.aggregate_in_box('sum', lo, hi), sum(inside) if inside else None)
+            self.assertEqual(tdbt.aggregate_in_box('max', lo, hi), max(inside, default=None))
+            self.assertEqual(tdbt.aggregate_in_box('min_weight', lo, hi), -max(inside) if inside else None)
+        self.assertEqual(tdbt.count_in_box((-50, -50, -50), (50, 50, 50)), len(points))
+        self.assertRaises(ValueError, tdbt.add_aggregate, 'median')
+
+        # queries prune on octant regions, bounds are only kept when asked for
+        self.assertNotIn('bounds', tdbt.aggregates)
+        tdbt.add_aggregate('bounds')
+        inside = [p for p in points if all(-10 <= p[a] <= 10 for a in range(3))]
+        expected = tuple(f(p[a] for p in inside) for a in range(3) for f in (min, max))
+        self.assertEqual(tdbt.aggregate_in_box('bounds', (-10, -10, -10), (10, 10, 10)), expected)
+
+    @timeout()
+    @number("3.15")
+    def test_iterators(self):
+        tdbt = ThreeDeeBeeTree()
+        self.assertEqual(list(tdbt), [])
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+
+        self.assertSetEqual(set(tdbt), set(self.TESTING_POINTS))
+        self.assertSetEqual(set(tdbt.items('breadth')), {(p, i) for i, p in enumerate(self.TESTING_POINTS)})
+        depth_first = list(tdbt.keys('depth'))
+        breadth_first = list(tdbt.keys('breadth'))
+        self.assertEqual(depth_first[:4], [(6, -1, -17), (-6, -14, 12), (-11, 4, -16), (-16, 2, -6)])
+        self.assertEqual(breadth_first[:4], [(6, -1, -17), (-6, -14, 12), (-11, 4, -16), (10, -20, 1)])
+        self.assertListEqual([node.key for node in tdbt.node_lst], depth_first)
+        self.assertRaises(ValueError, list, tdbt.keys('sideways'))
+
+        # a single path 2000 nodes deep, deeper than the recursion limit
+        tdbt = ThreeDeeBeeTree(keep_node_lst=True)
+        for i in range(2000):
+            tdbt[(i, i, i)] = i
+        self.assertEqual(sum(1 for _ in tdbt.keys()), 2000)
+        self.assertEqual(list(tdbt.items('breadth'))[-1], ((1999, 1999, 1999), 1999))
+        self.assertEqual(len(tdbt.node_lst), 2000)
+        del tdbt[(1990, 1990, 1990)]
+        self.assertEqual(len(tdbt.node_lst), 1999)
+
+    @timeout()
+    @number("3.16")
+    def test_snapshots(self):
+        self.assertRaises(ValueError, ThreeDeeBeeTree().snapshot)
+        tdbt = ThreeDeeBeeTree(balance_ratio=REBUILD_RATIO, copy_on_write=True)
+        tdbt.add_aggregate('sum')
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+        before = tdbt.snapshot()
+
+        del tdbt[(6, -1, -17)]
+        del tdbt[(-18, 7, 5)]
+        tdbt[(5, 5, 7)] = 100
+        for i in range(100):
+            tdbt[(i, i, i)] = 0
+
+        self.assertEqual(len(before), 10)
+        self.assertSetEqual(set(before.items()), {(p, i) for i, p in enumerate(self.TESTING_POINTS)})
+        self.assertEqual(before.aggregate_in_box('sum', (-20, -20, -20), (20, 20, 20)), 45)
+        self.assertRaises(TypeError, before.__setitem__, (0, 0, 0), 0)
+        after = tdbt.snapshot()
+        self.assertEqual(len(after), 108)
+        self.assertEqual(after[(5, 5, 7)], 100)
+        self.assertNotIn((6, -1, -17), after)
+        self.assertEqual(after.aggregate_in_box('sum', (-20, -20, -20), (20, 20, 20)), 137)
+
+        # readers never see a torn tree while a writer keeps inserting
+        errors = []
+        def read():
+            for _ in range(50):
+                snapshot = tdbt.snapshot()
+                keys = list(snapshot.keys())
+                if len(keys) != len(snapshot) or snapshot.root is None or snapshot.root.subtree_size != len(keys):
+                    errors.append(len(keys))
+        readers = [threading.Thread(target=read) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        random.seed(3317)
+        for i in range(500):
+            tdbt[(random.randint(100, 10000), random.randint(100, 10000), i)] = i
+        for reader in readers:
+            reader.join()
+        self.assertListEqual(errors, [])
+        self.assertEqual(len(tdbt.snapshot()), 608)
+
+        # batch lookups search each point once in one snapshot, so a delete published meanwhile raises nothing
+        churn = [(i, i, i) for i in range(100)]
+        def read_many():
+            for _ in range(50):
+                try:
+                    tdbt.get_many(churn)
+                except KeyError as error:
+                    errors.append(error)
+        readers = [threading.Thread(target=read_many) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        for _ in range(5):
+            for point in churn:
+                del tdbt[point]
+            for point in churn:
+                tdbt[point] = 0
+        for reader in readers:
+            reader.join()
+        self.assertListEqual(errors, [])
+        self.assertListEqual(tdbt.get_many(churn[:2] + [(-1, -1, -1)], default=-1), [0, 0, -1])
+
+        # an aggregate is registered under the write lock, never in the middle of an update
+        with tdbt.write_lock:
+            registering = threading.Thread(target=tdbt.add_aggregate, args=('bounds',))
+            registering.start()
+            registering.join(0.2)
+            self.assertTrue(registering.is_alive())
+            tdbt[(20, 20, 20)] = 0
+        registering.join()
+        self.assertEqual(tdbt.aggregate_in_box('bounds', (0, 0, 0), (20, 20, 20)), (0, 20, 0, 20, 0, 20))
+        count = len(list(tdbt.snapshot().range_query((0, 0, 0), (20, 20, 20))))
+        tdbt[(1, 2, 3)] = 0
+        self.assertEqual(tdbt.count_in_box((0, 0, 0), (20, 20, 20)), count + 1)
+
+    @timeout()
+    @number("3.17")
+    def test_lookup_cache(self):
+        random.seed(1717)
+        points = list({(random.randint(0, 300), random.randint(0, 300), random.randint(0, 300)) for _ in range(2000)})
+        plain = ThreeDeeBeeTree.from_points(points, list(range(len(points))))
+        for options in ({'cache_size': 16}, {'finger': True}, {'cache_size': 16, 'finger': True}):
+            tdbt = ThreeDeeBeeTree.from_points(points, list(range(len(points))), **options)
+            # nearby keys one after another, then the same keys again
+            for point in sorted(points) + sorted(points)[:50]:
+                self.assertEqual(tdbt[point], plain[point])
+            self.assertLessEqual(len(tdbt.cache), 16)
+            self.assertNotIn((301, 0, 0), tdbt)
+
+            # updates must not leave stale nodes behind
+            del tdbt[points[0]]
+            self.assertNotIn(points[0], tdbt)
+            tdbt[points[1]] = 'replaced'
+            tdbt[(301, 301, 301)] = 'new'
+            self.assertEqual(tdbt[points[1]], 'replaced')
+            self.assertEqual(tdbt[(301, 301, 301)], 'new')
+            for point in points[2:200]:
+                self.assertEqual(tdbt[point], plain[point])
+
+        self.assertRaises(ValueError, ThreeDeeBeeTree, cache_size=4, copy_on_write=True)
+
+        # an ancestor looked up after one of its descendants lies in the region of its octant 7 child
+        tdbt = ThreeDeeBeeTree(finger=True)
+        tdbt[(1, 4, 1)] = 0
+        tdbt[(7, 7, 6)] = 1
+        self.assertNotIn((1, 7, 0), tdbt)
+        self.assertNotIn((6, 6, 9), tdbt)
+        self.assertEqual(tdbt[(1, 4, 1)], 0)
+        self.assertEqual(tdbt[(7, 7, 6)], 1)
+
+        tdbt = ThreeDeeBeeTree(finger=True)
+        for point in points:
+            tdbt[point] = plain[point]
+        for point in random.sample(points, 500) + [tdbt.root.key]:
+            self.assertEqual(tdbt[point], plain[point])
+
+    @timeout()
+    @number("3.18")
+    def test_points_near_segment(self):
+        random.seed(1818)
+        points = list({(random.randint(-100, 100), random.randint(-100, 100), random.randint(-100, 100))
+                       for _ in range(2000)})
+        tdbt = ThreeDeeBeeTree.from_points(points, list(range(len(points))))
+
+        def near(point, a, b, r):
+            direction = [b[axis] - a[axis] for axis in range(3)]
+            length = sum(d * d for d in direction)
+            t = 0 if length == 0 else sum((point[axis] - a[axis]) * direction[axis] for axis in range(3)) / length
+            t = min(max(t, 0), 1)
+            return sum((point[axis] - a[axis] - t * direction[axis]) ** 2 for axis in range(3)) <= r * r, t
+
+        segments = [((-120, -80, 5), (110, 90, -20)), ((0, 0, 0), (0, 0, 0)), ((50, -100, 100), (50, 100, -100)),
+                    ((300, 300, 300), (400, 400, 400))]
+        results = tdbt.points_near_segments(segments, 12)
+        for (a, b), result in zip(segments, results):
+            expected = [p for p in points if near(p, a, b, 12)[0]]
+            self.assertSetEqual({key for key, _ in result}, set(expected))
+            self.assertEqual(len(result), len(expected))
+            params = [near(key, a, b, 12)[1] for key, _ in result]
+            self.assertListEqual(params, sorted(params))
+            for key, item in result:
+                self.assertEqual(points[item], key)
+
+            first = tdbt.points_near_segment(a, b, 12, limit=1)
+            self.assertListEqual(first, result[:1])
+        self.assertListEqual(results[3], [])
+
+    @timeout()
+    @number("3.19")
+    def test_join_within(self):
+        random.seed(1919)
+        hives = list({(random.randint(0, 200), random.randint(0, 200), random.randint(0, 200)) for _ in range(600)})
+        flowers = list({(random.randint(0, 200), random.randint(0, 200), random.randint(0, 200)) for _ in range(400)})
+        hive_tree = ThreeDeeBeeTree.from_points(hives)
+        flower_tree = ThreeDeeBeeTree()
+        for flower in flowers:
+            flower_tree[flower] = None
+
+        expected = {(h, f) for h in hives for f in flowers if sum((h[a] - f[a]) ** 2 for a in range(3)) <= 15 ** 2}
+        pairs = list(hive_tree.join_within(flower_tree, 15))
+        self.assertEqual(len(pairs), len(set(pairs)))
+        self.assertSetEqual(set(pairs), expected)
+        self.assertListEqual(list(hive_tree.join_within(ThreeDeeBeeTree(), 15)), [])
+        self.assertListEqual(list(hive_tree.join_within(flower_tree, -1)), [])
+        # a join computes the bounds it needs and registers no aggregate on either tree
+        self.assertDictEqual(hive_tree.aggregates, {})
+        self.assertDictEqual(flower_tree.aggregates, {})
+
+        # bounds kept by one of the trees are used and stay right after updates
+        hive_tree.add_aggregate('bounds')
+        for h in hives[:100]:
+            del hive_tree[h]
+        self.assertSetEqual(set(hive_tree.join_within(flower_tree, 15)), {p for p in expected if p[0] not in hives[:100]})
+        self.assertSetEqual(set(flower_tree.join_within(hive_tree, 15)),
+                            {(f, h) for h, f in expected if h not in hives[:100]})
+
+    @timeout()
+    @number("3.20")
+    def test_move(self):
+        random.seed(2020)
+        points = list({(random.randint(0, 500), random.randint(0, 500), random.randint(0, 500)) for _ in range(1500)})
+        for options in ({}, {'copy_on_write': True}):
+            tdbt = ThreeDeeBeeTree.from_points(points, list(range(len(points))), **options)
+            tdbt.add_aggregate('sum')
+            expected = dict(zip(points, range(len(points))))
+            for tick in range(5):
+                moves = []
+                for key in random.sample(sorted(expected), 200):
+                    new_key = tuple(c + random.randint(-3, 3) for c in key)
+                    if new_key not in expected and new_key not in {n for _, n in moves}:
+                        moves.append((key, new_key))
+                for old_key, new_key in moves[:20]:
+                    tdbt.move(old_key, new_key)
+                    expected[new_key] = expected.pop(old_key)
+                tdbt.move_many(moves[20:])
+                items = {old_key: expected.pop(old_key) for old_key, _ in moves[20:]}
+                expected.update((new_key, items[old_key]) for old_key, new_key in moves[20:])
+
+            self.assertEqual(len(tdbt), len(points))
+            self.assertEqual(tdbt.root.subtree_size, len(points))
+            self.assertDictEqual(dict(tdbt.items()), expected)
+            for key, item in expected.items():
+                self.assertEqual(tdbt[key], item)
+            self.assertEqual(tdbt.aggregate_in_box('sum', (-10, -10, -10), (510, 510, 510)), sum(range(len(points))))
+            # moves decide in place without keeping bounding boxes
+            self.assertNotIn('bounds', tdbt.aggregates)
+
+        # swaps, chains and invalid batches
+        tdbt = ThreeDeeBeeTree()
+        for i, point in enumerate(self.TESTING_POINTS):
+            tdbt[point] = i
+        a, b, c, d = self.TESTING_POINTS[:4]
+        tdbt.move_many([(a, b), (b, a), (c, (0, 0, 0)), (d, c)])
+        self.assertEqual((tdbt[a], tdbt[b], tdbt[(0, 0, 0)], tdbt[c]), (1, 0, 2, 3))
+        self.assertNotIn(d, tdbt)
+        self.assertRaises(ValueError, tdbt.move, a, b)
+        self.assertRaises(KeyError, tdbt.move, d, (1, 1, 1))
+        self.assertRaises(ValueError, tdbt.move_many, [(a, (1, 1, 1)), (b, (1, 1, 1))])
+        self.assertRaises(ValueError, tdbt.move_many, [(a, (1, 1, 1)), (b, c)])
+        self.assertEqual((tdbt[a], tdbt[b], len(tdbt)), (1, 0, 10))
+
+        # moves on trees with a lookup cache or a finger, looking keys up between moves
+        for options in ({'cache_size': 8}, {'finger': True}, {'cache_size': 8, 'finger': True}):
+            tdbt = ThreeDeeBeeTree(**options)
+            for i, point in enumerate(self.TESTING_POINTS[:4]):
+                tdbt[point] = i
+            self.assertEqual((tdbt[a], tdbt[b]), (0, 1))
+            tdbt.move_many([(a, b), (b, a)])
+            self.assertEqual((tdbt[a], tdbt[b], len(tdbt)), (1, 0, 4))
+
+            tdbt = ThreeDeeBeeTree.from_points(points, list(range(len(points))), **options)
+            expected = dict(zip(points, range(len(points))))
+            for key in random.sample(points, 300):
+                new_key = tuple(c + random.randint(-3, 3) for c in key)
+                if new_key in expected:
+                    continue
+                self.assertEqual(tdbt[key], expected[key])
+                tdbt.move(key, new_key)
+                expected[new_key] = expected.pop(key)
+                self.assertEqual(tdbt[new_key], expected[new_key])
+                self.assertNotIn(key, tdbt)
+            for key, item in expected.items():
+                self.assertEqual(tdbt[key], item)
+
+    @timeout()
+    @number("3.21")
+    def test_insert_batch(self):
+        random.seed(2121)
+        coords = list(range(30000))
+        random.shuffle(coords)
+        points = [(2 * coords[3*i], 2 * coords[3*i+1], 2 * coords[3*i+2]) for i in range(2000)]
+        # a dense batch in one corner, which naive insertion would pile into a few octants
+        batch = list(zip(*(random.sample(range(1, 6000, 2), 2500) for _ in range(3))))
+
+        for options in ({}, {'copy_on_write': True}, {'keep_node_lst': True}):
+            tdbt = ThreeDeeBeeTree.from_points(points, [1] * len(points), **options)
+            tdbt.add_aggregate('sum')
+            before = tdbt.snapshot() if 'copy_on_write' in options else None
+            tdbt.insert_batch(batch + points[:100], [1] * len(batch) + [2] * 100)
+            self.assertEqual(len(tdbt), len(points) + len(batch))
+            self.assertEqual(tdbt.root.subtree_size, len(tdbt))
+            for point in batch:
+                self.assertEqual(tdbt[point], 1)
+            for point in points[:100]:
+                self.assertEqual(tdbt[point], 2)
+            self.assertEqual(tdbt.aggregate_in_box('sum', (0, 0, 0), (60000, 60000, 60000)), len(tdbt) + 100)
+            self.assertLessEqual(max(tdbt.stats()['worst_ratio'].values()), REBUILD_RATIO)
+            if before is not None:
+                self.assertEqual(len(before), len(points))
+                self.assertCountEqual(list(before.keys()), points)
+                self.assertEqual(before.aggregate_in_box('sum', (0, 0, 0), (60000, 60000, 60000)), len(points))
+            if 'keep_node_lst' in options:
+                self.assertCountEqual([node.key for node in tdbt.node_lst], list(tdbt.keys()))
+
+        tdbt = ThreeDeeBeeTree()
+        tdbt.insert_batch(points)
+        self.assertEqual(len(tdbt), len(points))
+        self.assertLessEqual(max(tdbt.stats()['worst_ratio'].values()), 7)
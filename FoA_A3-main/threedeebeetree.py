@@ -1,84 +1,814 @@
 from __future__ import annotations
-from typing import Generic, TypeVar, Tuple
-from dataclasses import dataclass, field
-from referential_array import ArrayR
+from typing import Generic, Iterator, TypeVar
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from heap import MaxHeap
+import heapq
+from itertools import chain
+import mmap as mmap_module
+import operator
+import pickle
+import struct
+import sys
+import threading
+from partitioning import Point, ARRAY_CUTOFF, BALANCE_SLACK, SPLIT_RATIO, is_unbalanced_split, get_ratio_item, \
+    get_ratio_index, separate_octants_array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 I = TypeVar('I')
-Point = Tuple[int, int, int]
 
-@dataclass
-class BeeNode:
+# Index stored in the child table when an octant has no child.
+EMPTY = -1
+OCTANTS = 8
+# Layout of a saved tree: magic, format version, byte order ('<' or '>'), number of nodes, root index, number of
+# keys and the offset of the pickled items. The key, child and size arrays follow the header in that order.
+FILE_HEADER = struct.Struct('<4sBc2xqqqq')
+FILE_MAGIC = b'3DBT'
+FILE_VERSION = 1
+# Combine functions of the built-in aggregates, see ThreeDeeBeeTree.add_aggregate.
+AGGREGATES = {
+    'sum': operator.add,
+    'min': min,
+    'max': max,
+}
+# Split ratio that makes insert_batch rebuild a subtree, and the suggested balance_ratio. get_ratio_item picks roots
+# by percentiles of the distinct values rather than by sizes, so built splits come close to SPLIT_RATIO (and can
+# reach about 1:7.04): with a trigger of SPLIT_RATIO a few insertions rebuild the same subtree again.
+REBUILD_RATIO = 8
+# Octant region of the root for finger searches: (lo x, lo y, lo z, hi x, hi y, hi z), lo inclusive, hi exclusive.
+UNBOUNDED_REGION = (-float('inf'),) * 3 + (float('inf'),) * 3
 
-    key: Point
-    item: I
-    subtree_size: int = 1
-    children: list[BeeNode] = field(default_factory=list)
-    binary_lst: list[str] = field(default_factory=list)
 
-    def get_child_for_key(self, point: Point) -> BeeNode | None:
+def get_octant_code(key: Point, centre: Point) -> int:
+    """
+    Returns the 3-bit octant code of key relative to centre. Bit 2 is set when key is on the positive
+    (or equal) side of centre on the x axis, bit 1 for the y axis and bit 0 for the z axis.
+
+    complexity:
+    Best case = Worst case: O(1) * O(comp), where comp is comparison complexity, always 3 comparisons.
+    """
+    return ((key[0] >= centre[0]) << 2) | ((key[1] >= centre[1]) << 1) | (key[2] >= centre[2])
+
+
+def is_in_region(key: Point, region: tuple) -> bool:
+    """
+    Checks if key lies in region, a (lo x, lo y, lo z, hi x, hi y, hi z) box with inclusive lo and exclusive hi
+    bounds, i.e. the part of space covered by one subtree.
+    complexity: O(1)
+    """
+    return region[0] <= key[0] < region[3] and region[1] <= key[1] < region[4] and region[2] <= key[2] < region[5]
+
+
+def get_allowed_bits(lo: int, hi: int, split: int) -> tuple[int, ...]:
+    """
+    Returns the octant bits (0 for the < split side, 1 for the >= split side) of one axis whose half-space can
+    intersect the closed interval [lo, hi].
+
+    complexity:
+    Best case = Worst case: O(1) * O(comp), where comp is comparison complexity.
+    """
+    if hi < split:
+        return (0,)
+    if lo >= split:
+        return (1,)
+    return (0, 1)
+
+
+def get_box_distance(point: Point, region: tuple) -> float:
+    """
+    Returns the squared Euclidean distance from point to the box region = (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z),
+    0 if point lies inside it. Bounds may be infinite.
+
+    complexity:
+    Best case = Worst case: O(1) * O(comp), where comp is comparison complexity.
+    """
+    distance = 0
+    for axis in range(3):
+        lo, hi = region[2 * axis], region[2 * axis + 1]
+        if point[axis] < lo:
+            distance += (lo - point[axis]) ** 2
+        elif point[axis] > hi:
+            distance += (point[axis] - hi) ** 2
+    return distance
+
+
+def get_segment_param(point: Point, start: Point, direction: tuple) -> float:
+    """
+    Returns the parameter t in [0, 1] of the point start + t * direction of a segment closest to point.
+    complexity: O(1)
+    """
+    length = direction[0] ** 2 + direction[1] ** 2 + direction[2] ** 2
+    if length == 0:
+        return 0
+    t = sum((point[axis] - start[axis]) * direction[axis] for axis in range(3)) / length
+    return min(max(t, 0), 1)
+
+
+def clip_segment(start: Point, direction: tuple, region: tuple, margin: float) -> tuple[float, float] | None:
+    """
+    Returns the interval [t_enter, t_exit] of parameters t in [0, 1] for which start + t * direction lies in the
+    box region = (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z) grown by margin on every side, or None if the segment misses
+    it (the slab test). Bounds may be infinite.
+    complexity: O(1)
+    """
+    t_enter, t_exit = 0, 1
+    for axis in range(3):
+        lo, hi = region[2 * axis] - margin, region[2 * axis + 1] + margin
+        if direction[axis] == 0:
+            if not lo <= start[axis] <= hi:
+                return None
+            continue
+        t_lo, t_hi = (lo - start[axis]) / direction[axis], (hi - start[axis]) / direction[axis]
+        if t_lo > t_hi:
+            t_lo, t_hi = t_hi, t_lo
+        t_enter, t_exit = max(t_enter, t_lo), min(t_exit, t_hi)
+        if t_enter > t_exit:
+            return None
+    return t_enter, t_exit
+
+
+def get_boxes_distance(first: tuple, second: tuple) -> float:
+    """
+    Returns the squared Euclidean distance between two boxes (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z), 0 if they
+    overlap.
+    complexity: O(1)
+    """
+    distance = 0
+    for axis in range(0, 6, 2):
+        if first[axis + 1] < second[axis]:
+            distance += (second[axis] - first[axis + 1]) ** 2
+        elif second[axis + 1] < first[axis]:
+            distance += (first[axis] - second[axis + 1]) ** 2
+    return distance
+
+
+def get_point_box(point: Point) -> tuple:
+    """ Returns the box (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z) holding only point. """
+    return point[0], point[0], point[1], point[1], point[2], point[2]
+
+
+def merge_boxes(first: tuple, second: tuple) -> tuple:
+    """
+    Returns the smallest box (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z) holding both boxes.
+    complexity: O(1)
+    """
+    return (min(first[0], second[0]), max(first[1], second[1]), min(first[2], second[2]),
+            max(first[3], second[3]), min(first[4], second[4]), max(first[5], second[5]))
+
+
+def build_serialised_subtree(data: bytes, items: list) -> tuple:
+    """
+    Worker of ThreeDeeBeeTree.build_parallel: builds a balanced tree over the points in data, the bytes of a
+    flat native int64 coordinate array (x, y, z of each point in turn), items[i] being the item of point i, and
+    returns its store as compact arrays: (keys, children, sizes, items, root index).
+    complexity: see ThreeDeeBeeTree.from_points
+    """
+    coordinates = array('q')
+    coordinates.frombytes(data)
+    points = list(zip(coordinates[0::3], coordinates[1::3], coordinates[2::3]))
+    tree = ThreeDeeBeeTree.from_points(points, items)
+    store = tree.store
+    return store.keys, store.children, store.sizes, store.items, tree.root_index
+
+
+class BeeNodeStore(Generic[I]):
+    """
+    Storage engine of a 3DBT. Nodes live in parallel typed arrays and are referred to by their index:
+
+    - keys[3*i : 3*i + 3] is the point of node i
+    - items[i] is the item of node i
+    - sizes[i] is the subtree_size of node i
+    - children[8*i + code] is the index of the child of node i in octant code, or EMPTY
+
+    Slots of deleted nodes are kept in a free list and reused by add_node.
+    """
+
+    def __init__(self) -> None:
         """
+        Initialises an empty store
+        complexity: O(1)
+        """
+        self.keys = array('q')
+        self.items = []
+        self.sizes = array('q')
+        self.children = array('q')
+        self.free = []
+        # the memory mapped file backing the arrays of a tree loaded with ThreeDeeBeeTree.open
+        self.mapping = None
+
+    def __len__(self) -> int:
+        """ Returns the number of node slots in the store. """
+        return len(self.sizes)
+
+    def add_node(self, key: Point, item: I) -> int:
+        """
+        Adds a new leaf node, reusing a free slot if there is one, and returns its index.
         complexity:
-        Best case  = Worst Case: O(1) * O(comp),where O(comp) is the comparison's complexity get_octant is O(1) and everything is O(1)
+        Best case = Worst case: O(1) amortised, writing or appending a constant number of values to each array.
+        """
+        if self.free:
+            index = self.free.pop()
+            self.set_node(index, key, item)
+            return index
+        index = len(self.sizes)
+        self.keys.extend(key)
+        self.items.append(item)
+        self.sizes.append(1)
+        self.children.extend((EMPTY,) * OCTANTS)
+        return index
 
-        Best case same as worst case because they need to experience the same process no matter what
+    def set_node(self, index: int, key: Point, item: I) -> None:
         """
-        octant_index = self.get_octant(point) #O(1)
-        if octant_index is not None:
-            try:
-                node = self.children[octant_index]
-                return node
-            except IndexError:
-                return None
+        Overwrites the slot at index with a leaf node holding key and item.
+        complexity:
+        Best case = Worst case: O(1)
+        """
+        base = 3 * index
+        self.keys[base], self.keys[base + 1], self.keys[base + 2] = key
+        self.items[index] = item
+        self.sizes[index] = 1
+        first_slot = OCTANTS * index
+        self.children[first_slot:first_slot + OCTANTS] = array('q', (EMPTY,) * OCTANTS)
+
+    def add_nodes(self, count: int) -> list[int]:
+        """
+        Adds count node slots with no key, item or child, reusing free slots first, and returns their indices for
+        the caller to fill in.
+        complexity:
+        Best case = Worst case: O(count) amortised, each array growing in a single step.
+        """
+        reused = self.free[max(len(self.free) - count, 0):]
+        del self.free[len(self.free) - len(reused):]
+        start, added = len(self.sizes), count - len(reused)
+        self.keys.extend(array('q', (0,)) * (3 * added))
+        self.items.extend([None] * added)
+        self.sizes.extend(array('q', (0,)) * added)
+        self.children.extend(array('q', (EMPTY,)) * (OCTANTS * added))
+        return reused + list(range(start, start + added))
+
+    def clear_children(self, indices: list[int]) -> None:
+        """
+        Empties the child table of every node in indices.
+        complexity:
+        Best case = Worst case: O(m), where m = len(indices).
+        """
+        children = self.children
+        empty = array('q', (EMPTY,) * OCTANTS)
+        for index in indices:
+            children[OCTANTS * index:OCTANTS * index + OCTANTS] = empty
+
+    def copy_node(self, index: int) -> int:
+        """
+        Adds a copy of the node at index (key, item, subtree_size and children) and returns the copy's index.
+        complexity:
+        Best case = Worst case: O(1) amortised
+        """
+        copy = self.add_node(self.get_key(index), self.items[index])
+        self.sizes[copy] = self.sizes[index]
+        self.children[OCTANTS * copy:OCTANTS * copy + OCTANTS] = self.children[OCTANTS * index:OCTANTS * index + OCTANTS]
+        return copy
+
+    def free_node(self, index: int) -> None:
+        """
+        Releases the slot at index so add_node can reuse it.
+        complexity:
+        Best case = Worst case: O(1)
+        """
+        self.items[index] = None
+        self.sizes[index] = 0
+        first_slot = OCTANTS * index
+        self.children[first_slot:first_slot + OCTANTS] = array('q', (EMPTY,) * OCTANTS)
+        self.free.append(index)
+
+    def get_key(self, index: int) -> Point:
+        """ Returns the point of the node at index. """
+        keys = self.keys
+        return keys[3 * index], keys[3 * index + 1], keys[3 * index + 2]
 
-    def set_child_for_key(self, key, item):
+    def get_octant(self, index: int, key: Point) -> int:
         """
+        Returns the octant code of key relative to the node at index.
         complexity:
-        Best case = Worst Case: O(1) * O(comp),where O(comp) is the comparison's complexity get_octant is O(1) and everything is O(1)
+        Best case = Worst case: O(1) * O(comp), where comp is comparison complexity.
+        """
+        keys = self.keys
+        base = 3 * index
+        return ((key[0] >= keys[base]) << 2) | ((key[1] >= keys[base + 1]) << 1) | (key[2] >= keys[base + 2])
+
+    def get_child(self, index: int, octant: int) -> int:
+        """ Returns the index of the child of node index in the given octant, or EMPTY. """
+        return self.children[OCTANTS * index + octant]
+
+
+class BeeNode(Generic[I]):
+    """
+    View of a single node inside a BeeNodeStore. It holds no data of its own, so it is cheap to create and
+    always reflects the current state of the store.
+    """
+
+    __slots__ = ('store', 'index')
+
+    def __init__(self, store: BeeNodeStore[I], index: int) -> None:
+        self.store = store
+        self.index = index
+
+    @property
+    def key(self) -> Point:
+        return self.store.get_key(self.index)
+
+    @property
+    def item(self) -> I:
+        return self.store.items[self.index]
+
+    @item.setter
+    def item(self, item: I) -> None:
+        self.store.items[self.index] = item
+
+    @property
+    def subtree_size(self) -> int:
+        return self.store.sizes[self.index]
+
+    @property
+    def children(self) -> list[BeeNode | None]:
+        """ The 8 children of this node indexed by octant code, None where the octant is empty. """
+        return [self.get_child(octant) for octant in range(OCTANTS)]
+
+    def get_child(self, octant: int) -> BeeNode | None:
+        child = self.store.get_child(self.index, octant)
+        if child == EMPTY:
+            return None
+        return BeeNode(self.store, child)
+
+    def get_child_for_key(self, point: Point) -> BeeNode | None:
+        """
+        complexity:
+        Best case = Worst Case: O(1) * O(comp), where O(comp) is the comparison's complexity. get_octant is O(1)
+        and indexing the child table is O(1)
 
         Best case same as worst case because they need to experience the same process no matter what
         """
-        self.subtree_size += 1
-        new_node = BeeNode(key, item)
-        node = self.get_child_for_key(key)
-        octant_index = self.get_octant(key)
-        if node is None:
-            self.children.insert(octant_index, new_node)
-            return True
+        return self.get_child(self.get_octant(point))
 
-    def get_octant(self, key):
+    def get_octant(self, key: Point) -> int:
         """
         complexity:
         Best case = Worst case: O(1) * O(comp), where comp is comparison complexity
-                                the length of key is always 3. So is O(1). and the rest is O(1) as well
-                                so overall the complexity is O(1) * O(comp)
+                                the length of key is always 3, so the octant code is built with 3 comparisons
 
         Best case same as worst case because they need to experience the same process no matter what
         """
-        octant = ''
-        for i in range(len(key)): #constant 3
-            if key[i] >= self.key[i]:
-                octant += "1"
-            else:
-                octant += "0"
+        return self.store.get_octant(self.index, key)
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, BeeNode):
+            return self.store is other.store and self.index == other.index
+        return NotImplemented
 
-        if octant not in self.binary_lst: #O(comp)
-            self.binary_lst.append(octant)
+    def __hash__(self) -> int:
+        return hash((id(self.store), self.index))
 
-        octant_index = self.binary_lst.index(octant)
-        return octant_index
+    def __repr__(self) -> str:
+        return 'BeeNode(key={0}, item={1!r}, subtree_size={2})'.format(self.key, self.item, self.subtree_size)
 
 
 class ThreeDeeBeeTree(Generic[I]):
     """ 3️⃣🇩🐝🌳 tree. """
 
-    def __init__(self) -> None:
+    def __init__(self, balance_ratio: float | None = None, keep_node_lst: bool = False,
+                 copy_on_write: bool = False, cache_size: int = 0, finger: bool = False) -> None:
         """
             Initialises an empty 3DBT
+            balance_ratio: when given, any subtree whose split along one axis gets worse than 1:balance_ratio
+                           (see is_unbalanced) is rebuilt after an insertion or deletion. None never rebuilds.
+                           Must be at least REBUILD_RATIO: a rebuilt subtree may be split almost (or slightly more
+                           than) 1:SPLIT_RATIO, so a smaller ratio would rebuild the same subtrees on every update
+                           instead of once per O(size) updates.
+            keep_node_lst: keep a list of every node up to date on each update, see node_lst.
+            copy_on_write: never modify a node that is already in the tree. Updates copy the nodes on their path
+                           and publish the new root in one step, so readers can query snapshot() (or the tree
+                           itself) from other threads without locking. Old nodes are never freed. Aggregates
+                           are filled under the write lock and published only once complete.
+            cache_size: keep up to this many recently found keys in an LRU cache from key to node, 0 for none.
+            finger: start each search from the deepest node of the previous search path whose octant region
+                    holds the new key, instead of from the root (see finger_search).
+            The cache and the finger are cleared by every update. Neither can be used with copy_on_write, whose
+            readers should query snapshot() instead.
         """
-        self.root = None
+        if balance_ratio is not None and balance_ratio < REBUILD_RATIO:
+            raise ValueError('balance_ratio must be at least REBUILD_RATIO ({0})'.format(REBUILD_RATIO))
+        if keep_node_lst and copy_on_write:
+            raise ValueError('keep_node_lst cannot be used with copy_on_write')
+        if cache_size < 0:
+            raise ValueError('cache_size cannot be negative')
+        if (cache_size or finger) and copy_on_write:
+            raise ValueError('cache_size and finger cannot be used with copy_on_write')
+        self.balance_ratio = balance_ratio
+        self.copy_on_write = copy_on_write
+        # reentrant so that registering an aggregate (which takes the lock) also works during an update
+        self.write_lock = threading.RLock()
+        self.store = BeeNodeStore()
+        self.root_index = EMPTY
         self.length = 0
-        self.binary_lst = []
-        self.node_lst = []
+        self.read_only = False
+        self.aggregates = {}
+        self.kept_node_lst = [] if keep_node_lst else None
+        # (root index, length) of the latest complete update, replaced in a single assignment
+        self.version = (EMPTY, 0)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.finger = finger
+        # node indices of the last search path and the octant region of each of them
+        self.finger_path = []
+        self.finger_regions = []
+        # key of each node on the finger path -> its depth on the path
+        self.finger_keys = {}
+
+    @classmethod
+    def from_points(cls, points: list[Point], items: list[I] | None = None, workers: int = 1,
+                    **options) -> ThreeDeeBeeTree[I]:
+        """
+            Builds a balanced 3DBT directly from points, items[i] being the item of points[i] (None if items is
+            not given). Each partition picks its root with the same percentile criterion as
+            balancing.make_ordering and is split into its 8 octants in one pass. The root of each partition is
+            written straight into its parent's child slot and its subtree_size is the size of the partition, so
+            no point is ever inserted from the tree root. With NumPy, large partitions are picked and split on
+            index arrays (see build_subtree_array). Repeated points keep their last item. options (e.g.
+            balance_ratio) are passed on to the constructor of the new tree.
+
+            With workers > 1 the top levels are split in this process until there are at least workers
+            partitions, and each partition is then built in a pool of worker processes (see build_parallel).
+            complexity:
+            Best case = Worst case: O(n log n) * O(R), where n is the number of points and O(R) is the per point
+                        cost of picking a partition root. Every level of the partition touches each point once and
+                        the ratio criterion keeps the depth at O(log n).
+        """
+        if items is None:
+            items = [None] * len(points)
+        elif len(items) != len(points):
+            raise ValueError('points and items must have the same length')
+
+        tree = cls(**options)
+        item_of = dict(zip(map(tuple, points), items))
+        if item_of and workers > 1:
+            tree.root_index = tree.build_parallel(item_of, workers)
+        elif item_of:
+            tree.root_index = tree.build_subtree(item_of)
+        tree.length = len(item_of)
+        tree.version = (tree.root_index, tree.length)
+        return tree
+
+    def build_subtree(self, item_of: dict[Point, I], slots: list[int] | None = None) -> int:
+        """
+            Builds a balanced subtree holding every key of item_of and returns the index of its root. Nodes are
+            written into the given slots when provided (which must hold exactly len(item_of) indices), otherwise
+            they are all added to the store at once. Linking the returned root into the tree is left to the caller.
+            With NumPy, large subtrees are partitioned on index arrays first (see build_subtree_array).
+            complexity: see from_points
+        """
+        store = self.store
+        if slots is None:
+            slots = store.add_nodes(len(item_of))
+            if self.kept_node_lst is not None:
+                self.kept_node_lst.extend(BeeNode(store, node) for node in slots)
+        else:
+            store.clear_children(slots)
+        subtree_root = EMPTY
+        # each work entry is (partition, slot in the child table to link the partition root to)
+        work = [(list(item_of), EMPTY)]
+        if np is not None and len(item_of) > ARRAY_CUTOFF:
+            subtree_root, work = self.build_subtree_array(work[0][0], item_of, slots)
+        keys, items, sizes, children = store.keys, store.items, store.sizes, store.children
+        while work:
+            partition, slot = work.pop()
+            node, octants = self.place_partition(partition, item_of, slot, slots)
+            if slot == EMPTY:
+                subtree_root = node
+            for octant, octant_partition in enumerate(octants):
+                if len(octant_partition) == 1:
+                    # a leaf, about half of the nodes, is stored here rather than going through place_partition
+                    key = octant_partition[0]
+                    leaf = slots.pop()
+                    keys[3 * leaf], keys[3 * leaf + 1], keys[3 * leaf + 2] = key
+                    items[leaf] = item_of[key]
+                    sizes[leaf] = 1
+                    children[OCTANTS * node + octant] = leaf
+                elif octant_partition:
+                    work.append((octant_partition, OCTANTS * node + octant))
+        return subtree_root
+
+    def build_subtree_array(self, points: list[Point], item_of: dict[Point, I],
+                            slots: list[int]) -> tuple[int, list[tuple[list[Point], int]]]:
+        """
+            NumPy part of build_subtree: the points are put in one (N, 3) array and every partition is an array of
+            row indices into it, whose root is picked by partitioning.get_ratio_index and which is split by
+            partitioning.separate_octants_array, as in balancing.iter_roots_array. Partitions of at most
+            ARRAY_CUTOFF points are left to the list code of build_subtree. Nodes are written into slots, whose
+            children must be empty. Returns the index of the subtree root
+            and those small partitions as (points, child slot) work entries. The tree is the same one the list
+            code builds.
+            complexity:
+            Best case = Worst case: O(n log n), where n = len(points), see balancing.iter_roots_array.
+        """
+        store = self.store
+        keys, items, sizes = store.keys, store.items, store.sizes
+        coordinates = np.fromiter(chain.from_iterable(points), dtype=np.int64, count=3 * len(points)).reshape(-1, 3)
+        subtree_root = EMPTY
+        work, small = [(np.arange(len(points)), EMPTY)], []
+        while work:
+            indices, slot = work.pop()
+            if len(indices) <= ARRAY_CUTOFF:
+                small.append(([points[index] for index in indices.tolist()], slot))
+                continue
+            position = get_ratio_index(coordinates[indices])
+            root = points[indices[position]]
+            node = slots.pop()
+            keys[3 * node], keys[3 * node + 1], keys[3 * node + 2] = root
+            items[node] = item_of[root]
+            sizes[node] = len(indices)
+            if slot == EMPTY:
+                subtree_root = node
+            else:
+                store.children[slot] = node
+            # the octant arrays come in octant code 7 first
+            octants = separate_octants_array(coordinates, np.delete(indices, position), coordinates[indices[position]])
+            for octant in range(OCTANTS):
+                if len(octants[OCTANTS - 1 - octant]):
+                    work.append((octants[OCTANTS - 1 - octant], OCTANTS * node + octant))
+        return subtree_root, small
+
+    def place_partition(self, partition: list[Point], item_of: dict[Point, I], slot: int,
+                        slots: list[int] | None = None) -> tuple[int, list[list[Point]]]:
+        """
+            One step of build_subtree: picks the root of partition, stores it (in a slot taken from slots if
+            given, whose children must be empty, otherwise in a new node), links it to the child table entry slot
+            (unless slot is EMPTY) and splits the rest of the
+            partition by octant. Returns the new node's index and the 8 octant lists, or no lists for a
+            partition of one point (a leaf, about half of the nodes), which is neither searched nor split.
+            complexity:
+            Best case = Worst case: O(m) * O(comp) + O(R), where m = len(partition) and O(R) is the cost of
+                        picking its root.
+        """
+        store = self.store
+        root = partition[0] if len(partition) == 1 else get_ratio_item(partition)
+        if slots is None:
+            node = store.add_node(root, item_of[root])
+            if self.kept_node_lst is not None:
+                self.kept_node_lst.append(BeeNode(store, node))
+        else:
+            node = slots.pop()
+            keys = store.keys
+            keys[3 * node], keys[3 * node + 1], keys[3 * node + 2] = root
+            store.items[node] = item_of[root]
+        store.sizes[node] = len(partition)
+        if slot != EMPTY:
+            store.children[slot] = node
+        if len(partition) == 1:
+            return node, []
+
+        x, y, z = root
+        octants = [[] for _ in range(OCTANTS)]
+        for point in partition:
+            octants[((point[0] >= x) << 2) | ((point[1] >= y) << 1) | (point[2] >= z)].append(point)
+        octants[OCTANTS - 1].remove(root)
+        return node, octants
+
+    def build_parallel(self, item_of: dict[Point, I], workers: int) -> int:
+        """
+            Builds a balanced tree holding every key of item_of using a pool of worker processes and returns
+            the index of its root. The top levels are split here until there are at least workers partitions left
+            (see split_top_levels_array and split_top_levels). Each of those is sent to a worker as the bytes of
+            its flat coordinate array and the list of its items, built there by build_serialised_subtree, and the
+            returned arrays are appended to this store with their child indices shifted (in one vectorised step
+            with NumPy) and their root linked into its parent's child slot. The sizes of the top levels are the
+            sizes of their partitions, so every subtree_size is right once the pieces are stitched.
+            complexity:
+            Best case = Worst case: O(n log n / workers) * O(R) for the parallel builds, plus O(n) here to split the
+                        top levels and stitch the results, where n is the number of points. With NumPy that O(n)
+                        is done in vectorised steps rather than per point.
+        """
+        store = self.store
+        if np is None:
+            root, frontier = self.split_top_levels(item_of, workers)
+        else:
+            root, frontier = self.split_top_levels_array(item_of, workers)
+
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(pool.submit(build_serialised_subtree, data, items), slot) for data, items, slot in frontier]
+            del frontier
+            for future, slot in futures:
+                keys, children, sizes, items, subtree_root = future.result()
+                offset = len(store)
+                store.keys.extend(keys)
+                if np is None:
+                    store.children.extend(array('q', (child + offset if child != EMPTY else EMPTY
+                                                      for child in children)))
+                else:
+                    children = np.frombuffer(children, dtype=np.int64)
+                    store.children.frombytes(np.where(children != EMPTY, children + offset, EMPTY).tobytes())
+                store.sizes.extend(sizes)
+                store.items.extend(items)
+                store.children[slot] = subtree_root + offset
+                if self.kept_node_lst is not None:
+                    self.kept_node_lst.extend(BeeNode(store, node) for node in range(offset, len(store)))
+        return root
+
+    def split_top_levels(self, item_of: dict[Point, I], workers: int) -> tuple[int, list[tuple[bytes, list, int]]]:
+        """
+            Top levels of build_parallel without NumPy: partitions are placed by place_partition, level by level,
+            until there are at least workers left. Returns the index of the root and each remaining partition as
+            (bytes of its flat coordinate array, its items, child slot to link its root to).
+            complexity:
+            Best case = Worst case: O(n) * O(comp) + O(R) per level, where n = len(item_of).
+        """
+        root = EMPTY
+        frontier = [(list(item_of), EMPTY)]
+        while frontier and len(frontier) < workers:
+            next_frontier = []
+            for partition, slot in frontier:
+                node, octants = self.place_partition(partition, item_of, slot)
+                if slot == EMPTY:
+                    root = node
+                for octant, octant_partition in enumerate(octants):
+                    if octant_partition:
+                        next_frontier.append((octant_partition, OCTANTS * node + octant))
+            frontier = next_frontier
+        return root, [(array('q', chain.from_iterable(partition)).tobytes(), list(map(item_of.__getitem__, partition)),
+                       slot) for partition, slot in frontier]
+
+    def split_top_levels_array(self, item_of: dict[Point, I],
+                               workers: int) -> tuple[int, list[tuple[bytes, list, int]]]:
+        """
+            NumPy form of split_top_levels: the points are put in one (N, 3) array and every partition is an array
+            of row indices into it, whose root is picked by get_ratio_index and which is split by
+            separate_octants_array, as in build_subtree_array. The coordinates of a remaining partition are one
+            fancy-indexed slice of that array and its items are gathered from the row indices.
+            complexity:
+            Best case = Worst case: O(n log n) per level, done in vectorised steps, where n = len(item_of).
+        """
+        store = self.store
+        points, values = list(item_of), list(item_of.values())
+        coordinates = np.fromiter(chain.from_iterable(points), dtype=np.int64, count=3 * len(points)).reshape(-1, 3)
+        root = EMPTY
+        frontier = [(np.arange(len(points)), EMPTY)]
+        while frontier and len(frontier) < workers:
+            next_frontier = []
+            for indices, slot in frontier:
+                position = get_ratio_index(coordinates[indices])
+                row = int(indices[position])
+                node = store.add_node(points[row], values[row])
+                store.sizes[node] = len(indices)
+                if self.kept_node_lst is not None:
+                    self.kept_node_lst.append(BeeNode(store, node))
+                if slot == EMPTY:
+                    root = node
+                else:
+                    store.children[slot] = node
+                # the octant arrays come in octant code 7 first
+                octants = separate_octants_array(coordinates, np.delete(indices, position), coordinates[row])
+                for octant in range(OCTANTS):
+                    if len(octants[OCTANTS - 1 - octant]):
+                        next_frontier.append((octants[OCTANTS - 1 - octant], OCTANTS * node + octant))
+            frontier = next_frontier
+        return root, [(coordinates[indices].tobytes(), list(map(values.__getitem__, indices.tolist())), slot)
+                      for indices, slot in frontier]
+
+    def save(self, path: str) -> None:
+        """
+            Writes the tree to path in a flat binary layout: a FILE_HEADER, then the key, child and size arrays
+            of every node and finally the pickled items. Nodes are renumbered in depth-first order, so free
+            slots are dropped and each subtree is laid out close together.
+            complexity:
+            Best case = Worst case: O(n), where n is the number of nodes in the tree.
+        """
+        store = self.store
+        order = [] if self.root_index == EMPTY else self.get_subtree_indices(self.root_index)
+        new_index = {old: new for new, old in enumerate(order)}
+        new_index[EMPTY] = EMPTY
+        keys, children, sizes = array('q'), array('q'), array('q')
+        items = []
+        for old in order:
+            keys.extend(store.keys[3 * old:3 * old + 3])
+            children.extend(new_index[child] for child in store.children[OCTANTS * old:OCTANTS * old + OCTANTS])
+            sizes.append(store.sizes[old])
+            items.append(store.items[old])
+
+        byte_order = b'<' if sys.byteorder == 'little' else b'>'
+        items_offset = FILE_HEADER.size + 8 * (len(keys) + len(children) + len(sizes))
+        with open(path, 'wb') as file:
+            file.write(FILE_HEADER.pack(FILE_MAGIC, FILE_VERSION, byte_order, len(order), 0 if order else EMPTY,
+                                        self.length, items_offset))
+            for values in (keys, children, sizes):
+                file.write(values.tobytes())
+            pickle.dump(items, file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def open(cls, path: str, mmap: bool = True) -> ThreeDeeBeeTree[I]:
+        """
+            Loads a tree written by save. With mmap the key, child and size arrays are served straight from the
+            memory mapped file, so nothing but the items is deserialised, the pages are shared between processes
+            and the tree is read-only. Without mmap the arrays are copied into a regular, writable store.
+            complexity:
+            Best case = Worst case: O(n) to unpickle the n items, plus O(n) to copy the arrays when mmap is False.
+        """
+        with open(path, 'rb') as file:
+            data = mmap_module.mmap(file.fileno(), 0, access=mmap_module.ACCESS_READ)
+        magic, version, byte_order, count, root, length, items_offset = FILE_HEADER.unpack_from(data)
+        if magic != FILE_MAGIC or version != FILE_VERSION:
+            raise ValueError('{0} is not a saved ThreeDeeBeeTree'.format(path))
+        if byte_order != (b'<' if sys.byteorder == 'little' else b'>'):
+            raise ValueError('{0} was saved with a different byte order'.format(path))
+
+        tree = cls()
+        store = tree.store
+        offset = FILE_HEADER.size
+        arrays = []
+        for width in (3, OCTANTS, 1):
+            end = offset + 8 * width * count
+            if mmap:
+                arrays.append(memoryview(data)[offset:end].cast('q'))
+            else:
+                values = array('q')
+                values.frombytes(data[offset:end])
+                arrays.append(values)
+            offset = end
+        store.keys, store.children, store.sizes = arrays
+        store.items = pickle.loads(data[items_offset:])
+        tree.root_index = root
+        tree.length = length
+        tree.version = (root, length)
+        if mmap:
+            # the views keep the mapping alive, it is closed once the tree is garbage collected
+            store.mapping = data
+            tree.read_only = True
+        else:
+            data.close()
+        return tree
+
+    @property
+    def node_lst(self) -> list[BeeNode]:
+        """
+            Every node of the tree. If the tree was made with keep_node_lst this list is maintained on every
+            update, otherwise it is built on demand from a depth-first traversal.
+            complexity:
+            Best case: O(1), when the list is kept.
+            Worst case: O(n), where n is the number of nodes in the tree, to build it.
+        """
+        if self.kept_node_lst is not None:
+            return self.kept_node_lst
+        return [BeeNode(self.store, node) for node in self.iter_node_indices()]
+
+    def iter_node_indices(self, order: str = 'depth') -> Iterator[int]:
+        """
+            Yields the index of every node, either in depth-first pre-order ('depth', children in octant code
+            order) or level by level ('breadth'). An explicit stack or queue is used, so deep, skewed trees never
+            hit the recursion limit and no list of the nodes is built.
+            complexity:
+            Best case = Worst case: O(n), where n is the number of nodes in the tree, for a full traversal.
+        """
+        if order not in ('depth', 'breadth'):
+            raise ValueError("order must be 'depth' or 'breadth'")
+        if self.root_index == EMPTY:
+            return
+        children = self.store.children
+        pending = deque([self.root_index])
+        take = pending.pop if order == 'depth' else pending.popleft
+        while pending:
+            node = take()
+            yield node
+            node_children = children[OCTANTS * node:OCTANTS * node + OCTANTS]
+            if order == 'depth':
+                node_children = reversed(node_children)
+            for child in node_children:
+                if child != EMPTY:
+                    pending.append(child)
+
+    def keys(self, order: str = 'depth') -> Iterator[Point]:
+        """ Yields every key of the tree, in the order described in iter_node_indices. """
+        get_key = self.store.get_key
+        for node in self.iter_node_indices(order):
+            yield get_key(node)
+
+    def items(self, order: str = 'depth') -> Iterator[tuple[Point, I]]:
+        """ Yields every (key, item) pair of the tree, in the order described in iter_node_indices. """
+        get_key, items = self.store.get_key, self.store.items
+        for node in self.iter_node_indices(order):
+            yield get_key(node), items[node]
+
+    def __iter__(self) -> Iterator[Point]:
+        """ Iterates over the keys of the tree in depth-first order. """
+        return self.keys()
+
+    @property
+    def root(self) -> BeeNode | None:
+        """ The root node of the tree, or None when the tree is empty. """
+        if self.root_index == EMPTY:
+            return None
+        return BeeNode(self.store, self.root_index)
 
     def is_empty(self) -> bool:
         """
@@ -96,7 +826,7 @@ class ThreeDeeBeeTree(Generic[I]):
             Checks to see if the key is in the 3DBT
         """
         try:
-            self.get_tree_node_by_key(key)
+            self.get_node_index_by_key(key)
             return True
         except KeyError:
             return False
@@ -105,40 +835,205 @@ class ThreeDeeBeeTree(Generic[I]):
         """
             Attempts to get an item in the tree, it uses the Key to attempt to find it
         """
-        node = self.get_tree_node_by_key(key)
-        return node.item
+        return self.store.items[self.get_node_index_by_key(key)]
 
     def get_tree_node_by_key(self, key: Point) -> BeeNode:
         """
+            Returns the node holding key, raises KeyError if it is not in the tree
+            complexity: see get_node_index_by_key
+        """
+        return BeeNode(self.store, self.get_node_index_by_key(key))
+
+    def get_node_index_by_key(self, key: Point) -> int:
+        """
+        Returns the index of the node holding key, raises KeyError if it is not in the tree. Keys in the LRU cache
+        are answered straight away, and with finger the search goes through finger_search.
         Complexity:
         Best case: O(1) * O(comp), when the root is the key. No need further traverse so is O(1)
         Worst case: O(log n) * O(comp), where n is the number of nodes in the tree, comp is comparison complexity
                     when the key is the leaf node. Makes it keep traversing through the subtree until the leaf node.
                     so it depends on the depth, which is log n in a balanced tree
         """
-        if self.root.key == key:
-            return self.root
+        key = tuple(key)
+        cache = self.cache
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+        if self.finger:
+            current = self.finger_search(key)
         else:
-            flag = True
-            octant_index = self.root.get_octant(key) #O(1)
-            node = self.root.children[octant_index]
-            while flag: #O(
-                if node.key == key:
-                    return node
-                elif self.is_leaf(node):
-                    flag = False
-                    return None
-                else:
-                    octant_index = node.get_octant(key)
-                    node = node.children[octant_index]
+            keys, children = self.store.keys, self.store.children
+            current = self.root_index
+            while current != EMPTY:
+                base = 3 * current
+                x, y, z = keys[base], keys[base + 1], keys[base + 2]
+                if key[0] == x and key[1] == y and key[2] == z:
+                    break
+                octant = ((key[0] >= x) << 2) | ((key[1] >= y) << 1) | (key[2] >= z)
+                current = children[OCTANTS * current + octant]
+            else:
+                raise KeyError('Key not found: {0}'.format(key))
+        if self.cache_size:
+            cache[key] = current
+            if len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        return current
+
+    def finger_search(self, key: Point) -> int:
+        """
+            Returns the index of the node holding key, raises KeyError if it is not in the tree. A key held by a
+            node of the previous search path is answered straight away. Otherwise the search starts from the
+            deepest node of that path whose octant region (the box of points its subtree may hold) contains key,
+            and the path it takes replaces the rest of the previous one. A node's own key lies in the region of
+            its octant 7 child, which is why keys on the path must be checked first.
+            complexity:
+            Best case: O(1) * O(comp), when key is found at or just below the last node of the previous path.
+            Worst case: O(D) * O(comp), where D is the depth of the tree, when key lies in another octant of the
+                        root than the previous key: the path is scanned up to the root and then searched down.
+        """
+        if self.root_index == EMPTY:
+            raise KeyError('Key not found: {0}'.format(key))
+        path, regions, path_keys = self.finger_path, self.finger_regions, self.finger_keys
+        keys, children = self.store.keys, self.store.children
+        if not path:
+            path.append(self.root_index)
+            regions.append(UNBOUNDED_REGION)
+            path_keys[self.store.get_key(self.root_index)] = 0
+        if key in path_keys:
+            return path[path_keys[key]]
+        depth = len(path) - 1
+        while not is_in_region(key, regions[depth]):
+            depth -= 1
+        for node in path[depth + 1:]:
+            del path_keys[self.store.get_key(node)]
+        del path[depth + 1:], regions[depth + 1:]
+
+        current = path[depth]
+        lo_x, lo_y, lo_z, hi_x, hi_y, hi_z = regions[depth]
+        while True:
+            base = 3 * current
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            if key[0] == x and key[1] == y and key[2] == z:
+                return current
+            octant = ((key[0] >= x) << 2) | ((key[1] >= y) << 1) | (key[2] >= z)
+            current = children[OCTANTS * current + octant]
+            if current == EMPTY:
+                raise KeyError('Key not found: {0}'.format(key))
+            if key[0] >= x:
+                lo_x = x
+            else:
+                hi_x = x
+            if key[1] >= y:
+                lo_y = y
+            else:
+                hi_y = y
+            if key[2] >= z:
+                lo_z = z
+            else:
+                hi_z = z
+            path.append(current)
+            regions.append((lo_x, lo_y, lo_z, hi_x, hi_y, hi_z))
+            base = 3 * current
+            path_keys[keys[base], keys[base + 1], keys[base + 2]] = len(path) - 1
+
+    def clear_lookup_cache(self) -> None:
+        """
+            Forgets the cached keys and the finger path. Called on every update, as nodes may move or be freed.
+            complexity: O(C + D), where C is the cache size and D the length of the finger path.
+        """
+        self.cache.clear()
+        del self.finger_path[:], self.finger_regions[:]
+        self.finger_keys.clear()
+
+    def get_node_indices_many(self, points) -> np.ndarray:
+        """
+            Returns the node index of every row of points, an (N, 3) integer array, or EMPTY where the point is not
+            in the tree. All N searches advance together one level at a time, the octant codes of the whole batch
+            being computed with array comparisons against the store's arrays (viewed, not copied). Rows of another
+            dtype must hold integral values, which compare equal to the int keys as in __contains__; anything else
+            raises ValueError rather than being truncated into a false hit.
+            complexity:
+            Best case: O(N) * O(comp), when every point is found at the root.
+            Worst case: O(N * D) * O(comp), where D is the depth of the tree, done in D vectorised steps.
+        """
+        points = np.asarray(points).reshape(-1, 3)
+        if not np.issubdtype(points.dtype, np.integer):
+            integral = points.astype(np.int64)
+            if not (integral == points).all():
+                raise ValueError('points must have integer coordinates')
+            points = integral
+        found = np.full(len(points), EMPTY, dtype=np.int64)
+        if self.root_index == EMPTY:
+            return found
+        keys = np.frombuffer(self.store.keys, dtype=np.int64).reshape(-1, 3)
+        children = np.frombuffer(self.store.children, dtype=np.int64).reshape(-1, OCTANTS)
+        active = np.arange(len(points))
+        current = np.full(len(points), self.root_index, dtype=np.int64)
+        while active.size:
+            node_keys = keys[current]
+            queries = points[active]
+            equal = (queries == node_keys).all(axis=1)
+            found[active[equal]] = current[equal]
+            greater = queries >= node_keys
+            codes = (greater[:, 0] << 2) | (greater[:, 1] << 1) | greater[:, 2]
+            following = children[current, codes]
+            keep = ~equal & (following != EMPTY)
+            active, current = active[keep], following[keep]
+        # release the buffer views so the store's arrays can grow again
+        del keys, children
+        return found
+
+    def get_many(self, points, default=None):
+        """
+            Batch form of __getitem__: returns the item of every row of points (an (N, 3) integer array) as an
+            object array, with default where the point is not in the tree. Without NumPy the points are looked
+            up one at a time and a list is returned, as with copy_on_write (where NumPy views of the store would
+            stop a concurrent writer from growing it). With copy_on_write the whole batch is answered from one
+            snapshot, with a single search per point, so an update published meanwhile cannot remove a point
+            between finding it and reading its item.
+            complexity: see get_node_indices_many
+        """
+        if np is None or self.copy_on_write:
+            tree = self.snapshot() if self.copy_on_write else self
+            result = []
+            for point in map(tuple, points):
+                try:
+                    result.append(tree.store.items[tree.get_node_index_by_key(point)])
+                except KeyError:
+                    result.append(default)
+            return result
+        indices = self.get_node_indices_many(points)
+        result = np.full(len(indices), default, dtype=object)
+        items = self.store.items
+        positions = np.flatnonzero(indices != EMPTY)
+        for position, index in zip(positions.tolist(), indices[positions].tolist()):
+            result[position] = items[index]
+        return result
+
+    def contains_many(self, points):
+        """
+            Batch form of __contains__: returns a boolean array telling whether each row of points (an (N, 3)
+            integer array) is in the tree. Without NumPy, or with copy_on_write, a list is returned, in the latter
+            case from one snapshot as in get_many.
+            complexity: see get_node_indices_many
+        """
+        if np is None or self.copy_on_write:
+            tree = self.snapshot() if self.copy_on_write else self
+            return [point in tree for point in map(tuple, points)]
+        return self.get_node_indices_many(points) != EMPTY
 
     def __setitem__(self, key: Point, item: I) -> None:
-        self.root = self.insert_aux(self.root, key, item)
-        self.length += 1
+        if self.read_only:
+            raise TypeError('Cannot insert into a read-only tree')
+        with self.write_lock:
+            self.clear_lookup_cache()
+            self.root_index = self.insert_aux(self.root_index, key, item)
+            self.version = (self.root_index, self.length)
 
-    def insert_aux(self, current: BeeNode, key: Point, item: I) -> BeeNode:
+    def insert_aux(self, current: int, key: Point, item: I) -> int:
         """
-            Attempts to insert an item into the tree, it uses the Key to insert it
+            Attempts to insert an item into the subtree rooted at the node index current, it uses the Key to insert
+            it. If the key is already present its item is replaced. Returns the index of the subtree root.
             complexity:
 
             Balance tree
@@ -158,20 +1053,936 @@ class ThreeDeeBeeTree(Generic[I]):
                               down. So when it inserts the same symbol node. It needs to traverse all the way down to the bottom
                               to insert. So is O(n)
         """
-        if current is None:
-            new_node = BeeNode(key, item)
-            self.node_lst.append(new_node)
-            return new_node
+        key = tuple(key)
+        store = self.store
+        if current == EMPTY:
+            new_index = store.add_node(key, item)
+            if self.kept_node_lst is not None:
+                self.kept_node_lst.append(BeeNode(store, new_index))
+            self.length += 1
+            self.update_aggregates([new_index])
+            return new_index
+
+        keys, children = store.keys, store.children
+        path, slots = [], []
+        node = current
+        while True:
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            if key[0] == x and key[1] == y and key[2] == z:
+                path.append(node)
+                if self.copy_on_write:
+                    path, slots = self.copy_path(path, slots)
+                store.items[path[-1]] = item
+                self.update_aggregates(path)
+                return path[0]
+            path.append(node)
+            slot = OCTANTS * node + (((key[0] >= x) << 2) | ((key[1] >= y) << 1) | (key[2] >= z))
+            slots.append(slot)
+            child = children[slot]
+            if child == EMPTY:
+                break
+            node = child
+
+        if self.copy_on_write:
+            path, slots = self.copy_path(path, slots)
+            current = path[0]
+        new_index = store.add_node(key, item)
+        store.children[slots[-1]] = new_index
+        sizes = store.sizes
+        for ancestor in path:
+            sizes[ancestor] += 1
+        if self.kept_node_lst is not None:
+            self.kept_node_lst.append(BeeNode(store, new_index))
+        self.length += 1
+        self.update_aggregates(path + [new_index])
+        return self.rebalance_aux(current, path, slots)
+
+    def __delitem__(self, key: Point) -> None:
+        if self.read_only:
+            raise TypeError('Cannot delete from a read-only tree')
+        with self.write_lock:
+            self.clear_lookup_cache()
+            self.root_index = self.delete_aux(self.root_index, key)
+            self.version = (self.root_index, self.length)
+
+    def insert_batch(self, points: list[Point], items: list[I] | None = None) -> None:
+        """
+            Inserts every point of points, items[i] being the item of points[i] (None if items is not given).
+            Points already in the tree get their item replaced, repeated points keep their last item.
+            complexity: see insert_batch_aux
+        """
+        if self.read_only:
+            raise TypeError('Cannot insert into a read-only tree')
+        if items is None:
+            items = [None] * len(points)
+        elif len(items) != len(points):
+            raise ValueError('points and items must have the same length')
+        item_of = dict(zip(map(tuple, points), items))
+        with self.write_lock:
+            self.clear_lookup_cache()
+            self.root_index = self.insert_batch_aux(self.root_index, item_of)
+            self.version = (self.root_index, self.length)
+
+    def insert_batch_aux(self, current: int, item_of: dict[Point, I]) -> int:
+        """
+            Inserts the keys of item_of into the subtree rooted at the node index current and returns the index of
+            its root. Keys already present only get their item replaced. The new keys are routed down together:
+            at each node they are split by octant, and if adding them would leave the node out of balance (see
+            is_unbalanced, with balance_ratio or REBUILD_RATIO) its subtree is rebuilt balanced with them, reusing
+            its slots. Otherwise the node's size grows by the number of new keys below it and each octant's share goes on to
+            its child, or becomes a new balanced subtree where there is no child. With copy_on_write every node
+            the batch passes through is copied first and rebuilt subtrees go into new slots, so the old root
+            still shows the tree as it was.
+            complexity:
+            Best case: O(b log n) * O(comp), where b = len(item_of) and n is the size of the subtree, when no node
+                        goes out of balance.
+            Worst case: O((n + b) log(n + b)) * O(comp) when the root goes out of balance and the whole subtree is
+                        rebuilt. In general the cost is O(b log n) plus the sizes of the rebuilt subtrees, which
+                        only go out of balance after a batch of about their own size.
+        """
+        store = self.store
+        keys, children, sizes = store.keys, store.children, store.sizes
+        new_items = {}
+        for key, item in item_of.items():
+            try:
+                path = self.get_key_path(current, key)
+            except KeyError:
+                new_items[key] = item
+                continue
+            if self.copy_on_write:
+                # replacing the item copies the path to the key
+                current = self.insert_aux(current, key, item)
+                continue
+            store.items[path[-1]] = item
+            self.update_aggregates(path)
+        if not new_items:
+            return current
+        self.length += len(new_items)
+        if current == EMPTY:
+            current = self.build_subtree(new_items)
+            self.update_aggregates(self.get_subtree_indices(current))
+            return current
+
+        ratio = REBUILD_RATIO if self.balance_ratio is None else self.balance_ratio
+        root = current
+        # nodes whose aggregates must be recomputed, parents before children
+        touched = []
+        # entries are (node, new keys below it, child slot linking it to its parent or EMPTY for the root)
+        stack = [(current, list(new_items), EMPTY)]
+        while stack:
+            node, batch, slot = stack.pop()
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            octant_batches = [[] for _ in range(OCTANTS)]
+            for key in batch:
+                octant_batches[((key[0] >= x) << 2) | ((key[1] >= y) << 1) | (key[2] >= z)].append(key)
+
+            if self.is_unbalanced(node, ratio, [len(octant_batch) for octant_batch in octant_batches]):
+                subtree = self.get_subtree_indices(node)
+                subtree_items = {store.get_key(index): store.items[index] for index in subtree}
+                for key in batch:
+                    subtree_items[key] = new_items[key]
+                    if self.copy_on_write:
+                        continue
+                    index = store.add_node(key, None)
+                    subtree.append(index)
+                    if self.kept_node_lst is not None:
+                        self.kept_node_lst.append(BeeNode(store, index))
+                rebuilt = self.build_subtree(subtree_items, None if self.copy_on_write else subtree)
+                if slot == EMPTY:
+                    root = rebuilt
+                else:
+                    children[slot] = rebuilt
+                touched.extend(self.get_subtree_indices(rebuilt))
+                continue
+
+            if self.copy_on_write:
+                node = store.copy_node(node)
+                if slot == EMPTY:
+                    root = node
+                else:
+                    children[slot] = node
+            sizes[node] += len(batch)
+            touched.append(node)
+            for octant, octant_batch in enumerate(octant_batches):
+                if not octant_batch:
+                    continue
+                child_slot = OCTANTS * node + octant
+                child = children[child_slot]
+                if child == EMPTY:
+                    child = self.build_subtree({key: new_items[key] for key in octant_batch})
+                    children[child_slot] = child
+                    touched.extend(self.get_subtree_indices(child))
+                else:
+                    stack.append((child, octant_batch, child_slot))
+        self.update_aggregates(touched)
+        return root
+
+    def get_key_path(self, current: int, key: Point) -> list[int]:
+        """
+            Returns the indices of the nodes from current down to the node holding key, raises KeyError if key is
+            not in the subtree rooted at current.
+            complexity: see get_node_index_by_key
+        """
+        keys, children = self.store.keys, self.store.children
+        path = []
+        while current != EMPTY:
+            path.append(current)
+            base = 3 * current
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            if key[0] == x and key[1] == y and key[2] == z:
+                return path
+            current = children[OCTANTS * current + (((key[0] >= x) << 2) | ((key[1] >= y) << 1) | (key[2] >= z))]
+        raise KeyError('Key not found: {0}'.format(key))
+
+    def has_key_aux(self, current: int, key: Point) -> bool:
+        """
+            Checks if key is in the subtree rooted at current, without the lookup cache or the finger.
+            complexity: see get_node_index_by_key
+        """
+        try:
+            self.get_key_path(current, key)
+            return True
+        except KeyError:
+            return False
+
+    def move(self, old_key: Point, new_key: Point) -> None:
+        """
+            Moves the item at old_key to new_key. Raises KeyError if old_key is not in the tree and ValueError if
+            new_key already is (and is not old_key).
+            complexity: see move_aux
+        """
+        if self.read_only:
+            raise TypeError('Cannot move keys of a read-only tree')
+        with self.write_lock:
+            try:
+                self.root_index = self.move_aux(self.root_index, old_key, new_key)
+            finally:
+                self.clear_lookup_cache()
+            self.version = (self.root_index, self.length)
+
+    def move_many(self, moves) -> None:
+        """
+            Applies move to every (old key, new key) pair of moves, as if all of them happened at once: a key may
+            move to the old position of another moving key (e.g. two keys may swap). Every pair is checked before
+            the tree is changed, so an invalid batch leaves the tree untouched. Raises KeyError if an old key is
+            not in the tree and ValueError if an old or new key appears twice or a new key is held by a key that
+            does not move.
+            complexity:
+            Best case = Worst case: O(m) * O(M), where m = len(moves) and O(M) is the cost of one move_aux.
+        """
+        if self.read_only:
+            raise TypeError('Cannot move keys of a read-only tree')
+        moves = [(tuple(old_key), tuple(new_key)) for old_key, new_key in moves]
+        old_keys = {old_key for old_key, _ in moves}
+        new_keys = {new_key for _, new_key in moves}
+        if len(old_keys) != len(moves) or len(new_keys) != len(moves):
+            raise ValueError('Every key can only be moved once and to a different new key')
+        with self.write_lock:
+            for old_key, new_key in moves:
+                self.get_key_path(self.root_index, old_key)
+                if new_key not in old_keys and self.has_key_aux(self.root_index, new_key):
+                    raise ValueError('Key already in the tree: {0}'.format(new_key))
+
+            # a key moving onto a position that is still held is taken out and put back at the end
+            held, deferred = set(old_keys), []
+            try:
+                for old_key, new_key in moves:
+                    held.discard(old_key)
+                    if new_key in held:
+                        deferred.append((new_key, self.store.items[self.get_key_path(self.root_index, old_key)[-1]]))
+                        self.root_index = self.delete_aux(self.root_index, old_key)
+                    else:
+                        self.root_index = self.move_aux(self.root_index, old_key, new_key)
+                for new_key, item in deferred:
+                    self.root_index = self.insert_aux(self.root_index, new_key, item)
+            finally:
+                self.clear_lookup_cache()
+            self.version = (self.root_index, self.length)
 
-        node = current.set_child_for_key(key,item)
-        if node:
-            return self.root
+    def move_aux(self, current: int, old_key: Point, new_key: Point) -> int:
+        """
+            Moves the item at old_key to new_key in the subtree rooted at the node index current and returns the
+            index of the subtree root. If new_key still lies in the octant region of the node and every child
+            subtree stays on its side of new_key on each axis, only the node's key is changed. Otherwise the key
+            is deleted and reinserted. A child can only change side on an axis if it holds a key whose coordinate
+            lies between those of old_key and new_key, which has_key_in_slab looks for.
+            complexity:
+            Best case: O(D) * O(comp), where D is the depth of old_key, when the node is a leaf whose region still
+                        holds new_key, or the move is small and its slabs quickly leave the child subtrees.
+            Worst case: see delete_aux and insert_aux, when the move crosses the region of the node or a child.
+        """
+        old_key, new_key = tuple(old_key), tuple(new_key)
+        # the lookup cache may hold nodes this update is about to change, so the lookups here walk the tree
+        if old_key == new_key:
+            self.get_key_path(current, old_key)
+            return current
+        if self.has_key_aux(current, new_key):
+            raise ValueError('Key already in the tree: {0}'.format(new_key))
+        store = self.store
+        keys, children = store.keys, store.children
+        path, slots = [], []
+        lo, hi = [-float('inf')] * 3, [float('inf')] * 3
+        node = current
+        while node != EMPTY:
+            base = 3 * node
+            key = keys[base], keys[base + 1], keys[base + 2]
+            path.append(node)
+            if key == old_key:
+                break
+            octant = ((old_key[0] >= key[0]) << 2) | ((old_key[1] >= key[1]) << 1) | (old_key[2] >= key[2])
+            for axis in range(3):
+                if octant >> (2 - axis) & 1:
+                    lo[axis] = key[axis]
+                else:
+                    hi[axis] = key[axis]
+            slots.append(OCTANTS * node + octant)
+            node = children[slots[-1]]
         else:
-            child = current.get_child_for_key(key)
-            self.insert_aux(child, key, item)
+            raise KeyError('Key not found: {0}'.format(old_key))
+
+        in_place = all(lo[axis] <= new_key[axis] < hi[axis] for axis in range(3))
+        first_slot = OCTANTS * node
+        for axis in range(3):
+            if not in_place or old_key[axis] == new_key[axis]:
+                continue
+            # moving up, the children on the >= side may hold keys below new_key, and moving down the children
+            # on the < side may hold keys at or above it
+            upper_side = new_key[axis] > old_key[axis]
+            at_risk = [children[first_slot + octant] for octant in range(OCTANTS)
+                       if children[first_slot + octant] != EMPTY and bool(octant >> (2 - axis) & 1) == upper_side]
+            slab = min(old_key[axis], new_key[axis]), max(old_key[axis], new_key[axis])
+            in_place = not self.has_key_in_slab(at_risk, axis, slab[0], slab[1])
+        if not in_place:
+            item = store.items[node]
+            current = self.delete_aux(current, old_key)
+            return self.insert_aux(current, new_key, item)
+
+        if self.copy_on_write:
+            path, slots = self.copy_path(path, slots)
+        base = 3 * path[-1]
+        keys[base], keys[base + 1], keys[base + 2] = new_key
+        self.update_aggregates(path)
+        return path[0]
+
+    def has_key_in_slab(self, nodes: list[int], axis: int, lo: int, hi: int) -> bool:
+        """
+            Checks if a key of the subtrees rooted at nodes has its coordinate on axis in [lo, hi). Only the octants
+            whose half-space on that axis can meet the slab are visited.
+            complexity:
+            Best case: O(m), where m = len(nodes), when no subtree reaches into the slab past its root.
+            Worst case: O(s), where s is the total size of the subtrees, when the slab cuts through all of them.
+        """
+        keys, children = self.store.keys, self.store.children
+        bit = 1 << (2 - axis)
+        stack = list(nodes)
+        while stack:
+            node = stack.pop()
+            value = keys[3 * node + axis]
+            if lo <= value < hi:
+                return True
+            first_slot = OCTANTS * node
+            for octant in range(OCTANTS):
+                child = children[first_slot + octant]
+                # the >= side holds values from value up, the < side values below it
+                if child != EMPTY and (hi > value if octant & bit else lo < value):
+                    stack.append(child)
+        return False
+
+    def snapshot(self) -> ThreeDeeBeeTree[I]:
+        """
+            Returns a read-only tree sharing this tree's store that shows the tree as of the latest complete
+            update. Later updates never change it, so it can be queried from any thread without locking.
+            Only available with copy_on_write.
+            complexity:
+            Best case = Worst case: O(A), where A is the number of registered aggregates.
+        """
+        if not self.copy_on_write:
+            raise ValueError('Snapshots need a tree made with copy_on_write=True')
+        snapshot = ThreeDeeBeeTree(copy_on_write=True)
+        snapshot.store = self.store
+        snapshot.root_index, snapshot.length = snapshot.version = self.version
+        snapshot.aggregates = dict(self.aggregates)
+        snapshot.read_only = True
+        return snapshot
+
+    def copy_path(self, path: list[int], slots: list[int]) -> tuple[list[int], list[int]]:
+        """
+            Copies the nodes of path (a root to leaf path, with slots[i] the child slot from path[i] to the next
+            node) and links the copies together. Returns the copies and their child slots, which the caller can
+            then modify without touching any node reachable from an older root.
+            complexity:
+            Best case = Worst case: O(D), where D is the length of the path.
+        """
+        store = self.store
+        copies = [store.copy_node(node) for node in path]
+        copy_slots = [OCTANTS * copy + slot - OCTANTS * node for copy, node, slot in zip(copies, path, slots)]
+        for depth in range(len(copies) - 1):
+            store.children[copy_slots[depth]] = copies[depth + 1]
+        return copies, copy_slots
+
+    def delete_aux(self, current: int, key: Point) -> int:
+        """
+            Deletes key from the subtree rooted at the node index current and returns the index of the subtree
+            root. A leaf is simply unlinked. An inner node has no successor to swap with (its children are spread
+            over 8 octants), so the subtree below it is rebuilt balanced without it, reusing the same slots (or in
+            new slots with copy_on_write). Raises KeyError if key is not in the subtree.
+            complexity:
+            Best case: O(1) * O(comp), when the key is a leaf child of current.
+            Worst case: O(D + s log s) * O(comp), where D is the depth of the key and s is the size of its subtree,
+                        when an inner node is deleted and its subtree must be rebuilt. Deleting the root of the
+                        tree is therefore O(n log n).
+        """
+        key = tuple(key)
+        store = self.store
+        keys, children = store.keys, store.children
+        path, slots = [], []
+        node = current
+        while node != EMPTY:
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            if key[0] == x and key[1] == y and key[2] == z:
+                break
+            path.append(node)
+            slots.append(OCTANTS * node + (((key[0] >= x) << 2) | ((key[1] >= y) << 1) | (key[2] >= z)))
+            node = children[slots[-1]]
+        else:
+            raise KeyError('Key not found: {0}'.format(key))
+
+        replacement = EMPTY
+        if store.sizes[node] > 1:
+            subtree = self.get_subtree_indices(node)
+            subtree.remove(node)
+            item_of = {store.get_key(index): store.items[index] for index in subtree}
+            replacement = self.build_subtree(item_of, None if self.copy_on_write else subtree)
+            self.update_aggregates(self.get_subtree_indices(replacement))
+        if not self.copy_on_write:
+            store.free_node(node)
+        if self.kept_node_lst is not None:
+            self.kept_node_lst.remove(BeeNode(store, node))
+        self.length -= 1
+
+        if not path:
+            return replacement
+        if self.copy_on_write:
+            path, slots = self.copy_path(path, slots)
+            current = path[0]
+        children[slots[-1]] = replacement
+        sizes = store.sizes
+        for ancestor in path:
+            sizes[ancestor] -= 1
+        self.update_aggregates(path)
+        return self.rebalance_aux(current, path, slots)
+
+    def get_subtree_indices(self, current: int) -> list[int]:
+        """
+            Returns the indices of every node in the subtree rooted at current, using an explicit stack.
+            complexity:
+            Best case = Worst case: O(s), where s is the size of the subtree.
+        """
+        children = self.store.children
+        indices = []
+        stack = [current]
+        while stack:
+            node = stack.pop()
+            indices.append(node)
+            for child in children[OCTANTS * node:OCTANTS * node + OCTANTS]:
+                if child != EMPTY:
+                    stack.append(child)
+        return indices
+
+    def rebuild_subtree(self, current: int) -> int:
+        """
+            Rebuilds the subtree rooted at current balanced, in the same slots (new ones with copy_on_write), and
+            returns its new root index.
+            complexity: see build_subtree
+        """
+        store = self.store
+        subtree = self.get_subtree_indices(current)
+        item_of = {store.get_key(index): store.items[index] for index in subtree}
+        return self.build_subtree(item_of, None if self.copy_on_write else subtree)
+
+    def get_split_sizes(self, current: int, added: list[int] | None = None) -> list[tuple[int, int]]:
+        """
+            Returns, for each axis, the number of nodes below current on its < side and on its >= side, counting
+            added[octant] more nodes in each octant if added is given.
+            complexity:
+            Best case = Worst case: O(1), always 8 children.
+        """
+        children, sizes = self.store.children, self.store.sizes
+        split_sizes = [[0, 0], [0, 0], [0, 0]]
+        first_slot = OCTANTS * current
+        for octant in range(OCTANTS):
+            child = children[first_slot + octant]
+            size = 0 if child == EMPTY else sizes[child]
+            if added is not None:
+                size += added[octant]
+            if size:
+                split_sizes[0][(octant >> 2) & 1] += size
+                split_sizes[1][(octant >> 1) & 1] += size
+                split_sizes[2][octant & 1] += size
+        return [(negative, positive) for negative, positive in split_sizes]
+
+    def is_unbalanced(self, current: int, ratio: float = SPLIT_RATIO, added: list[int] | None = None) -> bool:
+        """
+            Checks the balance criterion of make_ordering at the node current (see is_unbalanced_split): on every
+            axis the two sides must have a size ratio of at most 1:ratio, unless both sides hold at most
+            BALANCE_SLACK nodes. With added, checks it as if added[octant] more nodes were in each octant.
+            complexity:
+            Best case = Worst case: O(1), always 8 children.
+        """
+        children, sizes = self.store.children, self.store.sizes
+        first_slot = OCTANTS * current
+        octant_sizes = [0 if children[first_slot + octant] == EMPTY else sizes[children[first_slot + octant]]
+                        for octant in range(OCTANTS)]
+        if added is not None:
+            octant_sizes = [size + extra for size, extra in zip(octant_sizes, added)]
+        return is_unbalanced_split(octant_sizes, ratio)
+
+    def stats(self) -> dict:
+        """
+            Returns structural statistics of the tree, gathered in one pass over its nodes:
+            size: the number of nodes.
+            depth_histogram: depth_histogram[d] is the number of nodes at depth d, the root being at depth 0.
+            average_path_length, max_path_length: the mean and largest number of nodes visited by a successful
+                                                  search, i.e. the depth of its node plus one.
+            worst_ratio: for each axis ('x', 'y', 'z'), the worst larger:smaller size ratio between the two sides
+                         of a split on that axis (1 if it is never worse), over the nodes where the larger side holds
+                         more than BALANCE_SLACK nodes, as in is_unbalanced. inf if the smaller side is empty.
+            fan_out: fan_out[k] is the number of nodes with k children.
+            complexity:
+            Best case = Worst case: O(n), where n is the number of nodes in the tree.
+        """
+        children = self.store.children
+        depth_histogram = []
+        fan_out = [0] * (OCTANTS + 1)
+        worst_ratio = [1, 1, 1]
+        total_path_length = 0
+        stack = [(self.root_index, 0)] if self.root_index != EMPTY else []
+        while stack:
+            current, depth = stack.pop()
+            if depth == len(depth_histogram):
+                depth_histogram.append(0)
+            depth_histogram[depth] += 1
+            total_path_length += depth + 1
+            child_count = 0
+            for slot in range(OCTANTS * current, OCTANTS * current + OCTANTS):
+                child = children[slot]
+                if child != EMPTY:
+                    child_count += 1
+                    stack.append((child, depth + 1))
+            fan_out[child_count] += 1
+            for axis, (negative, positive) in enumerate(self.get_split_sizes(current)):
+                smaller, larger = min(negative, positive), max(negative, positive)
+                if larger > BALANCE_SLACK:
+                    ratio = larger / smaller if smaller else float('inf')
+                    worst_ratio[axis] = max(worst_ratio[axis], ratio)
+
+        size = sum(depth_histogram)
+        return {
+            'size': size,
+            'depth_histogram': depth_histogram,
+            'average_path_length': total_path_length / size if size else 0,
+            'max_path_length': len(depth_histogram),
+            'worst_ratio': dict(zip('xyz', worst_ratio)),
+            'fan_out': fan_out,
+        }
+
+    def rebalance_aux(self, current: int, path: list[int], slots: list[int]) -> int:
+        """
+            Called after the subtree sizes along path (a root to leaf path starting at current, with slots[i] the
+            child slot from path[i] to the next node) have changed. If balance_ratio is set, the highest node on
+            the path that became unbalanced is the scapegoat and its subtree is rebuilt. Returns the index of the
+            subtree root, which changes if current itself is rebuilt.
+            complexity:
+            Best case: O(D), where D is the length of the path, when no node is unbalanced.
+            Worst case: O(D + s log s), where s is the size of the rebuilt subtree. As a rebuilt subtree needs
+                        O(s) further updates before it can become unbalanced again, this is O(log n) amortised
+                        per update in a balanced tree.
+        """
+        if self.balance_ratio is None:
+            return current
+        for depth, node in enumerate(path):
+            if self.is_unbalanced(node, self.balance_ratio):
+                new_node = self.rebuild_subtree(node)
+                self.update_aggregates(self.get_subtree_indices(new_node))
+                if depth == 0:
+                    return new_node
+                self.store.children[slots[depth - 1]] = new_node
+                return current
+        return current
+
+    def add_aggregate(self, name: str, combine=None, value=None) -> None:
+        """
+            Registers an aggregate over the items, cached at every node for its whole subtree so that
+            aggregate_in_box can answer for an octant without visiting it. combine must be associative and
+            commutative (defaults to AGGREGATES[name], e.g. 'sum', 'min' or 'max') and value maps an item to the
+            value being aggregated (defaults to the item itself). 'bounds' without combine or value caches the
+            bounding box (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z) of the keys instead, as used by join_within.
+            The cache is kept up to date by insertions, deletions and rebuilds (but not by assigning to
+            BeeNode.item directly), which then also recompute it along their path: every aggregate slows down
+            updates.
+            complexity:
+            Best case = Worst case: O(n), where n is the number of nodes in the tree, to fill the cache.
+        """
+        if name == 'bounds' and combine is None and value is None:
+            get_key = self.store.get_key
+            self.add_node_aggregate(name, merge_boxes, lambda node: get_point_box(get_key(node)))
+            return
+        if combine is None:
+            if name not in AGGREGATES:
+                raise ValueError('Unknown aggregate {0!r}, pass a combine function'.format(name))
+            combine = AGGREGATES[name]
+        if value is None:
+            value = lambda item: item
+        items = self.store.items
+        self.add_node_aggregate(name, combine, lambda node: value(items[node]))
+
+    def add_node_aggregate(self, name: str, combine, node_value) -> None:
+        """
+            Registers an aggregate of node_value(node index) over each subtree and fills its cache. The cache is
+            filled under the write lock before the aggregate is published, so neither an update nor a reader
+            ever sees it half filled.
+            complexity: see add_aggregate
+        """
+        aggregate = (combine, node_value, [])
+        with self.write_lock:
+            if self.root_index != EMPTY:
+                self.update_aggregates(self.get_subtree_indices(self.root_index), [aggregate])
+            self.aggregates[name] = aggregate
+
+    def update_aggregates(self, indices: list[int], aggregates=None) -> None:
+        """
+            Recomputes the cached aggregates of the nodes in indices, which must list every parent before its
+            children (e.g. a root to leaf path). Nodes are processed from the back so children are always done
+            before their parent. Only the given (combine, node_value, cache) aggregates are updated if aggregates
+            is given, all registered ones otherwise.
+            complexity:
+            Best case = Worst case: O(A * m), where m is len(indices) and A the number of aggregates.
+        """
+        store = self.store
+        children = store.children
+        if aggregates is None:
+            aggregates = list(self.aggregates.values())
+        for combine, node_value, cache in aggregates:
+            if len(cache) < len(store):
+                cache.extend([None] * (len(store) - len(cache)))
+            for node in reversed(indices):
+                total = node_value(node)
+                for child in children[OCTANTS * node:OCTANTS * node + OCTANTS]:
+                    if child != EMPTY:
+                        total = combine(total, cache[child])
+                cache[node] = total
+
+    def get_subtree_bounds(self, root: int) -> list[tuple]:
+        """
+            Returns, indexed by node, the bounding box (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z) of the keys of every
+            subtree below root: the cached 'bounds' aggregate if the tree keeps it (see add_aggregate), otherwise
+            a list computed for the caller alone, which later updates neither use nor maintain.
+            complexity:
+            Best case: O(1), when the bounds are cached.
+            Worst case: O(s), where s is the size of the subtree rooted at root, to compute them.
+        """
+        if 'bounds' in self.aggregates:
+            return self.aggregates['bounds'][2]
+        get_key = self.store.get_key
+        bounds = []
+        if root != EMPTY:
+            self.update_aggregates(self.get_subtree_indices(root),
+                                   [(merge_boxes, lambda node: get_point_box(get_key(node)), bounds)])
+        return bounds
+
+    def count_in_box(self, lo: Point, hi: Point) -> int:
+        """
+            Returns the number of keys inside the box lo <= key <= hi. A subtree whose octant region lies inside
+            the box is counted from its subtree_size without being visited.
+            complexity: see aggregate_box_aux
+        """
+        sizes = self.store.sizes
+        count = self.aggregate_box_aux(lo, hi, operator.add, sizes.__getitem__, lambda node: 1)
+        return count or 0
+
+    def aggregate_in_box(self, name: str, lo: Point, hi: Point):
+        """
+            Returns the aggregate registered as name (see add_aggregate) over the items whose keys lie inside the
+            box lo <= key <= hi, or None if the box holds no key. Subtrees inside the box use their cached value.
+            complexity: see aggregate_box_aux
+        """
+        combine, node_value, cache = self.aggregates[name]
+        return self.aggregate_box_aux(lo, hi, combine, cache.__getitem__, node_value)
 
-        return self.root
+    def aggregate_box_aux(self, lo: Point, hi: Point, combine, subtree_value, node_value):
+        """
+            Combines subtree_value(node) for every subtree whose octant region (the box of points it may hold,
+            bounded by the keys of its ancestors) lies inside the box lo..hi and node_value(node) for every other
+            node whose key lies inside it. As in iter_range, octants whose region misses the box are skipped.
+            Returns None if nothing was combined.
+            complexity:
+            Best case: O(1), when the box misses every octant of the root but one, which is empty.
+            Worst case: O(n), where n is the number of nodes in the tree, when every region straddles the
+                        boundary of the box. Usually only the subtrees along the boundary are visited.
+        """
+        store = self.store
+        keys, children = store.keys, store.children
+        lo_x, lo_y, lo_z = lo
+        hi_x, hi_y, hi_z = hi
+        inf = float('inf')
+        result = None
+        # regions are (lo_x, hi_x, lo_y, hi_y, lo_z, hi_z), holding the keys with lo <= key < hi on every axis
+        stack = [] if self.root_index == EMPTY else [(self.root_index, (-inf, inf, -inf, inf, -inf, inf))]
+        while stack:
+            node, region = stack.pop()
+            region_lo_x, region_hi_x, region_lo_y, region_hi_y, region_lo_z, region_hi_z = region
+            if lo_x <= region_lo_x and region_hi_x <= hi_x and lo_y <= region_lo_y and region_hi_y <= hi_y and \
+                    lo_z <= region_lo_z and region_hi_z <= hi_z:
+                total = subtree_value(node)
+                result = total if result is None else combine(result, total)
+                continue
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            if lo_x <= x <= hi_x and lo_y <= y <= hi_y and lo_z <= z <= hi_z:
+                total = node_value(node)
+                result = total if result is None else combine(result, total)
+
+            first_slot = OCTANTS * node
+            for x_bit in get_allowed_bits(lo_x, hi_x, x):
+                for y_bit in get_allowed_bits(lo_y, hi_y, y):
+                    for z_bit in get_allowed_bits(lo_z, hi_z, z):
+                        child = children[first_slot + ((x_bit << 2) | (y_bit << 1) | z_bit)]
+                        if child != EMPTY:
+                            stack.append((child, (
+                                x if x_bit else region_lo_x, region_hi_x if x_bit else x,
+                                y if y_bit else region_lo_y, region_hi_y if y_bit else y,
+                                z if z_bit else region_lo_z, region_hi_z if z_bit else z,
+                            )))
+        return result
+
+    def range_query(self, lo: Point, hi: Point) -> list[tuple[Point, I]]:
+        """
+            Returns every (key, item) pair whose key lies inside the axis-aligned box lo <= key <= hi
+            (inclusive on every axis).
+            complexity: see iter_range
+        """
+        return list(self.iter_range(lo, hi))
+
+    def iter_range(self, lo: Point, hi: Point) -> Iterator[tuple[Point, I]]:
+        """
+            Lazily yields every (key, item) pair whose key lies inside the box lo <= key <= hi.
+            A child octant is only visited when its half-spaces relative to the parent's key can intersect the box.
+            complexity:
+            Best case: O(1) * O(comp), when the box only overlaps a single octant of the root and the root has no
+                        child there.
+            Worst case: O(n) * O(comp), where n is the number of nodes in the tree, when the box contains every point.
+                        In general the cost is O(k + D) octant visits, where k is the number of points reported and
+                        D is the depth of the tree, plus the nodes along the boundary of the box.
+        """
+        store = self.store
+        keys, children, items = store.keys, store.children, store.items
+        lo_x, lo_y, lo_z = lo
+        hi_x, hi_y, hi_z = hi
+        stack = [] if self.root_index == EMPTY else [self.root_index]
+        while stack:
+            node = stack.pop()
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            if lo_x <= x <= hi_x and lo_y <= y <= hi_y and lo_z <= z <= hi_z:
+                yield (x, y, z), items[node]
+
+            # the octant bits each axis may take: 1 is the key >= side, 0 the key < side
+            x_bits = get_allowed_bits(lo_x, hi_x, x)
+            y_bits = get_allowed_bits(lo_y, hi_y, y)
+            z_bits = get_allowed_bits(lo_z, hi_z, z)
+            first_slot = OCTANTS * node
+            for x_bit in x_bits:
+                for y_bit in y_bits:
+                    for z_bit in z_bits:
+                        child = children[first_slot + ((x_bit << 2) | (y_bit << 1) | z_bit)]
+                        if child != EMPTY:
+                            stack.append(child)
+
+    def points_near_segment(self, a: Point, b: Point, r: float, limit: int | None = None) -> list[tuple[Point, I]]:
+        """
+            Returns the (key, item) pairs of the keys within distance r of the segment from a to b, ordered front to
+            back by where along the segment they are closest to it. With limit, stops after the first limit hits,
+            e.g. limit=1 for the first point the segment passes.
+            complexity: see iter_near_segment
+        """
+        result = []
+        if limit is not None and limit <= 0:
+            return result
+        for hit in self.iter_near_segment(a, b, r):
+            result.append(hit)
+            if len(result) == limit:
+                break
+        return result
 
+    def points_near_segments(self, segments, r: float, limit: int | None = None) -> list[list[tuple[Point, I]]]:
+        """
+            Batch form of points_near_segment: returns its result for each (a, b) pair of segments.
+            complexity: see iter_near_segment, for each segment
+        """
+        return [self.points_near_segment(a, b, r, limit) for a, b in segments]
+
+    def iter_near_segment(self, a: Point, b: Point, r: float) -> Iterator[tuple[Point, I]]:
+        """
+            Lazily yields the (key, item) pairs of the keys within distance r of the segment from a to b, front to
+            back: by the parameter t of the point a + t * (b - a) closest to the key. Octants are visited in the
+            order the segment enters their region grown by r, and an octant it never enters is never visited. A key
+            within r of the segment at t lies in that grown region for t, so a hit is only yielded once no octant
+            left in the frontier could hold an earlier one, and stopping the generator stops the search.
+            complexity:
+            Best case: O(D) * O(comp), where D is the depth of the tree, when the segment only reaches one octant
+                        per level.
+            Worst case: O(n log n) * O(comp), where n is the number of nodes in the tree, when the grown segment
+                        reaches every octant.
+        """
+        if self.root_index == EMPTY:
+            return
+        store = self.store
+        keys, children, items = store.keys, store.children, store.items
+        direction = (b[0] - a[0], b[1] - a[1], b[2] - a[2])
+        squared_r = r * r
+        inf = float('inf')
+
+        root_region = (-inf, inf, -inf, inf, -inf, inf)
+        if clip_segment(a, direction, root_region, r) is None:
+            return
+        # frontier entries are (t, tie breaker, node, region), region being None for a hit waiting to be yielded
+        frontier = [(0, 0, self.root_index, root_region)]
+        pushed = 1
+        while frontier:
+            t, _, node, region = heapq.heappop(frontier)
+            if region is None:
+                yield store.get_key(node), items[node]
+                continue
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            t_key = get_segment_param((x, y, z), a, direction)
+            closest = (a[0] + t_key * direction[0], a[1] + t_key * direction[1], a[2] + t_key * direction[2])
+            if (x - closest[0]) ** 2 + (y - closest[1]) ** 2 + (z - closest[2]) ** 2 <= squared_r:
+                heapq.heappush(frontier, (t_key, pushed, node, None))
+                pushed += 1
+
+            lo_x, hi_x, lo_y, hi_y, lo_z, hi_z = region
+            first_slot = OCTANTS * node
+            for octant in range(OCTANTS):
+                child = children[first_slot + octant]
+                if child == EMPTY:
+                    continue
+                child_region = (
+                    max(lo_x, x) if octant & 4 else lo_x, hi_x if octant & 4 else min(hi_x, x),
+                    max(lo_y, y) if octant & 2 else lo_y, hi_y if octant & 2 else min(hi_y, y),
+                    max(lo_z, z) if octant & 1 else lo_z, hi_z if octant & 1 else min(hi_z, z),
+                )
+                interval = clip_segment(a, direction, child_region, r)
+                if interval is not None:
+                    heapq.heappush(frontier, (interval[0], pushed, child, child_region))
+                    pushed += 1
+
+    def join_within(self, other: ThreeDeeBeeTree, r: float) -> Iterator[tuple[Point, Point]]:
+        """
+            Lazily yields every (key of this tree, key of other) pair at Euclidean distance at most r, descending
+            both trees together. Each work entry pairs a subtree (or a single node's key) of each tree, and is
+            dropped when the bounding boxes of the two sides (see get_subtree_bounds) are further apart than r.
+            Otherwise the larger side is split into its node's key and its child subtrees. Only one stack of pairs
+            is kept, so memory stays bounded by the depth of the trees rather than the number of matches. Neither
+            tree is changed: a tree that does not keep the 'bounds' aggregate has its bounds computed for this
+            join only.
+            complexity:
+            Best case: O(n + m), where n and m are the sizes of the trees, to compute their bounds, when the
+                        bounding boxes of the two trees are further apart than r. O(1) if both trees keep bounds.
+            Worst case: O(n * m), when every pair matches.
+                        With few matches the cost is close to O((n + m) log(n + m)) pair visits.
+        """
+        roots = (self.root_index, other.root_index)
+        if r < 0 or EMPTY in roots:
+            return
+        stores = (self.store, other.store)
+        bounds = (self.get_subtree_bounds(roots[0]), other.get_subtree_bounds(roots[1]))
+        squared_r = r * r
+        # entries are (node of this tree, whole subtree?, node of other, whole subtree?)
+        stack = [(roots[0], True, roots[1], True)]
+        while stack:
+            entry = stack.pop()
+            boxes = [bounds[side][entry[2 * side]] if entry[2 * side + 1] else
+                     get_point_box(stores[side].get_key(entry[2 * side])) for side in range(2)]
+            if get_boxes_distance(boxes[0], boxes[1]) > squared_r:
+                continue
+            if not entry[1] and not entry[3]:
+                yield stores[0].get_key(entry[0]), stores[1].get_key(entry[2])
+                continue
+            # split the whole subtree side holding more nodes
+            if entry[1] and (not entry[3] or stores[0].sizes[entry[0]] >= stores[1].sizes[entry[2]]):
+                side = 0
+            else:
+                side = 1
+            node = entry[2 * side]
+            children = stores[side].children
+            parts = [(node, False)] + [(child, True) for child in children[OCTANTS * node:OCTANTS * node + OCTANTS]
+                                       if child != EMPTY]
+            for part in parts:
+                stack.append(part + entry[2:] if side == 0 else entry[:2] + part)
+
+    def nearest(self, point: Point, k: int = 1) -> list[tuple[Point, I]]:
+        """
+            Returns the (key, item) pairs of the k keys closest to point (Euclidean distance), nearest first.
+            Octants are explored best-first by the distance from point to their region, and the k best candidates
+            so far are kept in a MaxHeap so the worst of them is always at hand. An octant whose region is already
+            further away than the current k-th candidate is never visited.
+            complexity:
+            Best case: O(k log k) * O(comp), when the k nearest keys sit on the first path explored and every other
+                        octant is pruned straight away.
+            Worst case: O(n log n) * O(comp), where n is the number of nodes in the tree, when no octant can be
+                        pruned (e.g. k >= n) and every node goes through the frontier heap.
+        """
+        if k <= 0 or self.root_index == EMPTY:
+            return []
+        k = min(k, self.length)
+        store = self.store
+        keys, children, items = store.keys, store.children, store.items
+        px, py, pz = point
+        inf = float('inf')
+
+        candidates = MaxHeap(k)
+        # frontier entries are (distance to the octant region, tie breaker, node, region)
+        frontier = [(0, 0, self.root_index, (-inf, inf, -inf, inf, -inf, inf))]
+        pushed = 1
+        while frontier:
+            bound, _, node, region = heapq.heappop(frontier)
+            if len(candidates) == k and bound > candidates.peek_max()[0]:
+                break
+            base = 3 * node
+            x, y, z = keys[base], keys[base + 1], keys[base + 2]
+            distance = (x - px) ** 2 + (y - py) ** 2 + (z - pz) ** 2
+            if len(candidates) < k:
+                candidates.add((distance, (x, y, z), node))
+            elif distance < candidates.peek_max()[0]:
+                candidates.get_max()
+                candidates.add((distance, (x, y, z), node))
+
+            lo_x, hi_x, lo_y, hi_y, lo_z, hi_z = region
+            first_slot = OCTANTS * node
+            for octant in range(OCTANTS):
+                child = children[first_slot + octant]
+                if child == EMPTY:
+                    continue
+                child_region = (
+                    max(lo_x, x) if octant & 4 else lo_x, hi_x if octant & 4 else min(hi_x, x),
+                    max(lo_y, y) if octant & 2 else lo_y, hi_y if octant & 2 else min(hi_y, y),
+                    max(lo_z, z) if octant & 1 else lo_z, hi_z if octant & 1 else min(hi_z, z),
+                )
+                child_bound = get_box_distance(point, child_region)
+                if len(candidates) < k or child_bound <= candidates.peek_max()[0]:
+                    heapq.heappush(frontier, (child_bound, pushed, child, child_region))
+                    pushed += 1
+
+        result = []
+        while len(candidates) > 0:
+            _, key, node = candidates.get_max()
+            result.append((key, items[node]))
+        result.reverse()
+        return result
 
     def is_leaf(self, current: BeeNode) -> bool:
         """ Simple check whether or not the node is a leaf. """
@@ -185,7 +1996,3 @@ if __name__ == "__main__":
     tdbt[(5, 4, 0)] = "D"
 
     print(tdbt.root.get_child_for_key((4, 3, 1)).subtree_size) # 2
-
-
-
-